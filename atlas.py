@@ -2,9 +2,14 @@
 
 from PyQt4 import QtGui, QtCore, uic
 from simulation import Simulation
+from simthread import SimThread
 import layoutgen
 
 import sys
+import logging
+
+# Times a second the window is refreshed from the simulation
+FRAME_RATE = 30
 
 colors = ('#00FF00', '#FF0000', '#E3CF57', '#0000FF', '#FF00FF', '#00FFFF',
           '#FFFF00', '#FFC0CB', '#C67171', '#000000')
@@ -20,51 +25,73 @@ class MainWindow(QtGui.QMainWindow, layoutgen.MainStats):
         self.sim.add_jobs()
         self.sim.farm.groups.update_quota(self.sim.farm)
 
+        # The simulation runs in a thread of its own as fast as the delay
+        # allows, the window shows the latest snapshot of it FRAME_RATE times
+        # a second. From here on the simulation is only changed through
+        # self.runner.call()
+        self.period = self.simspeedSlider.value()
+        self.runner = SimThread(self.sim, self.stepSize.value(), self.period / 1000.0)
+        self.snapshot = self.runner.latest()
+
         self.timer = QtCore.QTimer(self)
-        self.timer.timeout.connect(self.advance_interval)
+        self.timer.timeout.connect(self.refresh)
 
         self.quitBtn.clicked.connect(self.close)
-        self.stepBtn.clicked.connect(self.advance_interval)
+        self.stepBtn.clicked.connect(self.runner.step_once)
+        self.stepSize.valueChanged.connect(self.runner.set_step_size)
         self.radioDepthFirst.toggled.connect(self.toggle_fill_algorithm)
         self.radioBreadthFirst.toggled.connect(self.toggle_fill_algorithm)
         self.startStop.clicked.connect(self.toggle_run)
         self.simspeedSlider.valueChanged.connect(self.change_speed)
         self.to_plot = set(g.name for g in self.sim.farm.groups.active_groups())
         self.all_groups = self.sim.display_order()
+        # Rows of the snapshots' plot data the canvas has areas for
+        self._plotted = None
 
-        # ms between firing timer
-        self.period = 350
         self.auto_run = False
 
-        self.qedit = ManageQueues(self.sim)
+        self.qedit = ManageQueues(self.sim, self.runner)
         self.quitBtn.clicked.connect(self.qedit.close)
         self.toolButton.clicked.connect(self.qedit.show)
         self.make_status_layout()
 
+        self.runner.start()
+        self.timer.start(1000 / FRAME_RATE)
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.runner.stop()
+        super(MainWindow, self).closeEvent(event)
+
     def change_speed(self, val):
 
         self.simspeedSlider.setToolTip(str(val))
         self.simspeedLabel.setText('%dms delay' % val)
         self.period = val
-        if self.auto_run:
-            self.timer.start(val)
-
-    def advance_interval(self):
-        self.sim.step(self.stepSize.value())
-        t = self.sim.farm.time
+        self.runner.delay = val / 1000.0
+
+    def refresh(self):
+        """ Show the latest snapshot of the simulation, if there's a new one """
+        snap = self.runner.latest()
+        if snap is None:
+            return
+        self.snapshot = snap
+        t = snap.time
         st = 't=%d (n in %d, s in %d)' % (t,
-             self.sim.next_negotiate - t, self.sim.next_submit - t)
+             snap.next_negotiate - t, snap.next_submit - t)
         self.timeLabel.setText(st)
         for grp, lbl in self._stat_labels.items():
-            group = self.sim.farm.groups.get_by_name(grp)
-            lbl.setText(self._format_grpstr(group))
+            lbl.setText(self._format_grpstr(snap.groups[grp]))
         self.update_plot()
 
     def update_plot(self):
-        x, y = self.sim.make_plotdata(self.to_plot)
-        self.mpl.canvas.ax.cla()
-        self.mpl.canvas.ax.stackplot(x, y, colors=self.gen_color(), baseline='zero')
-        self.mpl.canvas.draw()
+        snap = self.snapshot
+        rows = [n for n, g in enumerate(self.all_groups) if g in self.to_plot]
+        canvas = self.mpl.canvas
+        if rows != self._plotted:
+            canvas.set_layers(list(self.gen_color()))
+            self._plotted = rows
+        canvas.stack(snap.x, snap.y[rows])
 
     def gen_color(self):
         for n, grp in enumerate(self.all_groups):
@@ -73,34 +100,37 @@ class MainWindow(QtGui.QMainWindow, layoutgen.MainStats):
 
     def toggle_fill_algorithm(self, state):
         if state and 'DepthFirst' in self.sender().objectName():
-            self.sim._set_neg_df()
+            self.runner.call(self.sim._set_neg_df)
         elif state and 'BreadthFirst' in self.sender().objectName():
-            self.sim._set_neg_bf()
+            self.runner.call(self.sim._set_neg_bf)
 
     def toggle_run(self):
         if self.auto_run:
-            self.timer.stop()
+            self.runner.pause()
             self.startStop.setText('Run')
             self.auto_run = False
         else:
-            self.timer.start(self.period)
+            self.runner.resume()
             self.startStop.setText('Pause')
             self.auto_run = True
 
 
 class ManageQueues(QtGui.QDialog, layoutgen.QueueManage):
 
-    def __init__(self, simulation, parent=None):
+    def __init__(self, simulation, runner, parent=None):
         super(ManageQueues, self).__init__(parent)
         uic.loadUi('ui/queue_dialog.ui', self)
         self.closeButton.clicked.connect(self.close)
         self.sim = simulation
+        self.runner = runner
         self.sliders = {}
 
         self.add_controls()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format="(%(levelname)5s) %(message)s")
     app = QtGui.QApplication(sys.argv)
     win = MainWindow()
     win.show()
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+""" Scaling benchmarks for the computefarm hot paths.
+
+    For every combination of farm size and queue size a fresh simulation is
+    built in a child process and the time taken by Farm.negotiate_jobs,
+    Farm.advance_time, Farm.update_usage, JobQueue.match_jobs and a run of
+    Simulation.step is measured, along with throughput and the peak memory
+    of the process. Results are written as JSON so runs of different
+    versions can be compared with --compare.
+
+    Idle jobs of one group and shape (an autocluster) are matched together,
+    so for a given farm the negotiation times should stay flat down the
+    queue sizes once the queue holds more than the farm can take: compare
+    negotiate and negotiate_full across the rows of one farm size, shapes
+    being the number of autoclusters.
+
+    With --shards the cases are run again with the farm partitioned between
+    that many worker processes (see computefarm.PartitionedFarm), shards 0
+    being a plain Farm, to compare their wall times.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from computefarm import IDLE
+from simulation import Simulation, HOUR
+
+FARM_SIZES = (400, 4000, 40000, 100000)
+QUEUE_SIZES = (1000, 10000, 100000, 1000000)
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+def fill_queue(sim, jobs):
+    """ Submit about @jobs idle jobs, shared between groups by quota """
+    groups = list(sim.farm.groups.active_groups())
+    total = float(sum(g.quota for g in groups))
+    for g in groups:
+        g.num = int(round(jobs * g.quota / total))
+    sim.add_jobs()
+
+
+def run_case(nodes, jobs, step_time, shards=0):
+    """ Benchmark one farm/queue size, returning a dict of results """
+
+    res = {'nodes': nodes, 'jobs': jobs, 'shards': shards}
+
+    res['build_farm'], sim = timed(lambda: Simulation(nodes, shards=shards or None))
+    res['submit'], _ = timed(fill_queue, sim, jobs)
+    farm = sim.farm
+    res['queued'] = len(sim.queue)
+    res['shapes'] = sum(len(sim.queue.autoclusters(g.name))
+                        for g in farm.groups.active_groups())
+
+    # An empty farm, so a large number of matches in the first cycle
+    running = farm.groups.running
+    res['negotiate'], _ = timed(farm.negotiate_jobs)
+    matches = farm.groups.running - running
+    res['matches'] = matches
+    res['matches_per_sec'] = matches / max(res['negotiate'], 1e-9)
+
+    # A second cycle on a full farm is mostly rejections
+    res['negotiate_full'], _ = timed(farm.negotiate_jobs)
+
+    ticks = 20
+    t, _ = timed(lambda: [farm.advance_time(sim.sec_per_step) for _ in xrange(ticks)])
+    res['advance_time'] = t / ticks
+
+    t, _ = timed(lambda: [farm.update_usage() for _ in xrange(100)])
+    res['update_usage'] = t / 100
+
+    biggest = max(farm.groups.active_groups(), key=lambda g: g.idle)
+    res['match_jobs'], found = timed(
+        lambda: sum(1 for _ in sim.queue.match_jobs({'group': biggest.name,
+                                                     'state': IDLE})))
+    res['match_jobs_found'] = found
+
+    # Full simulation loops, both with fixed ticks and event to event
+    steps = int(step_time / sim.sec_per_step)
+    res['step_ticks'], _ = timed(sim.step, steps)
+    res['step_ticks_sim_per_sec'] = step_time / max(res['step_ticks'], 1e-9)
+    sim.set_event_driven(True)
+    res['step_events'], _ = timed(sim.step, steps)
+    res['step_events_sim_per_sec'] = step_time / max(res['step_events'], 1e-9)
+
+    # ru_maxrss is in kilobytes on Linux, of this process only with shards
+    res['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    sim.farm.close()
+    return res
+
+
+def _child(conn, nodes, jobs, step_time, shards):
+    try:
+        conn.send(run_case(nodes, jobs, step_time, shards))
+    except Exception as e:
+        conn.send({'nodes': nodes, 'jobs': jobs, 'shards': shards, 'error': repr(e)})
+    conn.close()
+
+
+def run_isolated(nodes, jobs, step_time, shards=0):
+    """ Run a case in its own process so peak memory is measured per case """
+    parent, child = multiprocessing.Pipe(False)
+    proc = multiprocessing.Process(target=_child,
+                                   args=(child, nodes, jobs, step_time, shards))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def environment():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = None
+    return {
+        'revision': rev,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.node(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+# Columns printed in the summary table and compared between result files
+_report = ('negotiate', 'matches_per_sec', 'negotiate_full', 'advance_time', 'update_usage',
+           'match_jobs', 'step_ticks_sim_per_sec', 'step_events_sim_per_sec',
+           'peak_rss_mb')
+
+
+def _case(r):
+    # Result files from before --shards have no shards
+    return r['nodes'], r['jobs'], r.get('shards', 0)
+
+
+def print_table(results, fp=sys.stdout):
+    fp.write("%8s %8s %6s " % ('nodes', 'jobs', 'shards') +
+             " ".join("%12.12s" % c for c in _report) + "\n")
+    for r in results:
+        if 'error' in r:
+            fp.write("%8d %8d %6d  %s\n" % (_case(r) + (r['error'],)))
+            continue
+        fp.write("%8d %8d %6d " % _case(r) +
+                 " ".join("%12.4g" % r[c] for c in _report) + "\n")
+
+
+def compare(old, new, fp=sys.stdout):
+    """ Print new/old ratios for every case present in both result files """
+    prev = dict((_case(r), r) for r in old['results'] if 'error' not in r)
+    fp.write("new/old %8s %8s %6s " % ('nodes', 'jobs', 'shards') +
+             " ".join("%12.12s" % c for c in _report) + "\n")
+    for r in new['results']:
+        o = prev.get(_case(r))
+        if o is None or 'error' in r:
+            continue
+        fp.write("        %8d %8d %6d " % _case(r) +
+                 " ".join("%12.3f" % (r[c] / o[c] if o[c] else float('nan'))
+                          for c in _report) + "\n")
+
+
+def _sizes(text):
+    return [int(x) for x in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--farms', type=_sizes, default=FARM_SIZES,
+                        help='comma separated farm sizes (default: %(default)s)')
+    parser.add_argument('--jobs', type=_sizes, default=QUEUE_SIZES,
+                        help='comma separated queue sizes (default: %(default)s)')
+    parser.add_argument('--step-time', type=float, default=HOUR,
+                        help='simulated seconds for the Simulation.step runs')
+    parser.add_argument('--shards', type=_sizes, default=[0],
+                        help='comma separated numbers of worker processes to '
+                             'partition the farm between, 0 for a plain farm '
+                             '(default: %(default)s)')
+    parser.add_argument('-o', '--output', default='bench_output.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--compare', metavar='OLD',
+                        help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    results = []
+    for nodes in args.farms:
+        for jobs in args.jobs:
+            for shards in args.shards:
+                sys.stderr.write("Running %d nodes, %d jobs, %d shards...\n" %
+                                 (nodes, jobs, shards))
+                results.append(run_isolated(nodes, jobs, args.step_time, shards))
+
+    out = {'environment': environment(), 'results': results}
+    with open(args.output, 'w') as fp:
+        json.dump(out, fp, indent=1, sort_keys=True)
+
+    print_table(results)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), out)
+
+
+if __name__ == '__main__':
+    main()
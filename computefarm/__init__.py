@@ -1,14 +1,9 @@
 #!/usr/bin/python
 
-import sys
-import logging
-
 __all__ = ['IDLE', 'RUNNING', 'COMPLETED', 'BatchExcept',
-           'Farm', 'Group', 'BatchJob', 'Machine', 'JobQueue']
-
-
-logging.basicConfig(stream=sys.stdout, level=logging.INFO,
-                    format="(%(levelname)5s) %(message)s")
+           'Farm', 'Group', 'BatchJob', 'Machine', 'JobQueue', 'EventQueue',
+           'Trace', 'StatStore', 'SteadyState', 'SeriesWriter', 'SeriesReader', 'Replay',
+           'read_log', 'Ranking', 'PartitionedFarm']
 
 
 IDLE = 0
@@ -24,3 +19,10 @@ from groups import Group
 from job import BatchJob
 from machine import Machine
 from queue import JobQueue
+from events import EventQueue
+from trace import Trace
+from stats import StatStore, SteadyState
+from series import SeriesWriter, SeriesReader
+from workload import Replay, read_log
+from ranking import Ranking
+from partition import PartitionedFarm
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+import heapq
+import itertools
+import math
+
+# Event types, events falling on the same time are handled in this order which
+# is the same order things happen inside one tick of Simulation.step
+COMPLETE = 0
+SUBMIT = 1
+NEGOTIATE = 2
+STAT = 3
+
+
+class EventQueue(object):
+    """ A priority queue of timed events used when the simulation runs in
+        discrete-event mode, where time jumps straight to the next event
+        instead of being advanced in fixed-size ticks.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+
+    def push(self, time, kind, data=None):
+        # The sequence number keeps events of equal time and kind in FIFO order
+        heapq.heappush(self._heap, (time, kind, self._seq.next(), data))
+
+    def pop(self):
+        """ Remove and return the next event as a (time, kind, data) tuple """
+        time, kind, _, data = heapq.heappop(self._heap)
+        return time, kind, data
+
+    def next_time(self):
+        """ Time of the next event or None if the queue is empty """
+        return self._heap[0][0] if self._heap else None
+
+    def next_kind(self):
+        return self._heap[0][1] if self._heap else None
+
+    def __iter__(self):
+        """ Iterate over pending events (unordered) as (time, kind, data) """
+        return ((x[0], x[1], x[3]) for x in self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def quantize(time, quantum):
+    """ Round @time up to the next multiple of @quantum, with a quantum of 0
+        times are left as they are (continuous time)
+    """
+    if not quantum:
+        return time
+    return int(math.ceil(float(time) / quantum)) * quantum
+
+
+def first_tick_after(time, quantum):
+    """ The first multiple of @quantum strictly greater than @time, this is
+        when a tick-based loop testing "now > time" would first fire
+    """
+    if not quantum:
+        return time
+    return (int(math.floor(float(time) / quantum)) + 1) * quantum
@@ -3,15 +3,21 @@
 import logging
 from collections import defaultdict
 
-from computefarm import RUNNING, IDLE
-from machine import Machine
+import numpy as np
+
+from computefarm import RUNNING, IDLE, BatchExcept
+from machine import Machine, MachineTable
+from job import JobTable, RunningJobs
+from groups import Group
+from queue import JobQueue
+from events import EventQueue, COMPLETE, quantize
+from slots import SlotIndex
+# The built-in rankings used to be functions defined here
+from ranking import depth_first, breadth_first, largest_first, rankings, from_spec
+import trace as tr
 
 log = logging.getLogger('sim')
 
-largest_first = lambda key: key.totalcpus
-breadth_first = lambda key: key.cpus
-depth_first = lambda key: -key.cpus
-
 
 class EndNegCycle(Exception):
     pass
@@ -25,31 +31,63 @@ class Farm(object):
     """
     """
 
+    # Cross-check the live group counters against a full recount of the queue
+    # every time update_usage() is called
+    debug_counters = False
+
+    # Look up indexed rankings in the SlotIndex rather than scoring all
+    # machines in the MachineTable
+    use_slot_index = True
+
     def __init__(self, ranking=depth_first):
         self._m = list()
+        self._table = MachineTable()
+        self._running = RunningJobs()
+        self._slots = SlotIndex()
+        self._cpus = 0
         self.queues = list()
+        self.queue = None
         self.groups = None
+
+        # A trace.Trace to record negotiation decisions in, if any
+        self.trace = None
+
+        self.reset_neg_stats()
         self.set_negotiatior_rank(ranking)
         self.time = 0
 
+        # Pending job completions, only kept when running event-driven
+        self._completions = None
+        self.quantum = 0
+
+        # (cpus, memory) of jobs found not to fit anywhere this cycle
+        self._no_fit = []
+
     def __iter__(self):
         return iter(self._m)
 
+    def count_machines(self):
+        return len(self._m)
+
     def count_cpus(self):
-        return sum(x.totalcpus for x in self._m)
+        """ Total cpus of the farm, counted as machines are added """
+        return self._cpus
 
     def count_memory(self):
-        return sum(x.totalmemory for x in self._m)
+        return self._table.totalmemory[:self._table.size].sum()
 
     def set_negotiatior_rank(self, fn):
-        """ Jobsorter functions need to return the best slot with the
-            highest number
+        """ Set the ranking.Ranking policy machines are picked for jobs
+            with, or anything ranking.from_spec() takes. Plain functions of a
+            machine need to return the best slot with the highest number.
         """
-        self._jobsorter = fn
+        self._jobsorter = from_spec(fn)
 
     @staticmethod
     def slotweight(job):
-        """ We define slotweight just as CPUs, no matter the memory usage """
+        """ We define slotweight just as CPUs, no matter the memory usage, the
+            group counters rely on this when counting jobs in bulk
+        """
         return job.cpus
 
     def generate_from_dist(self, cpuweights, size=None):
@@ -64,51 +102,388 @@ class Farm(object):
 
         if not size:
             for cpus, count in cpuweights:
-                for n in xrange(count):
-                    self._m.append(Machine(cpus=cpus))
+                self.add_machines(cpus, count)
         else:
             total = sum(x[1] for x in cpuweights)
             for cpus, count in cpuweights:
-                for x in xrange(int(size * (count / float(total)))):
-                    self._m.append(Machine(cpus=cpus))
-
-        log.info("Added %d machines to farm", len(self._m))
+                self.add_machines(cpus, int(size * (count / float(total))))
+
+        log.info("Added %d machines to farm", self.count_machines())
+
+    def add_machine(self, machine):
+        """ Add a Machine, its resources are moved into the farm's table """
+        machine.move_to(self._table)
+        self._cpus += int(machine.totalcpus)
+        self._m.append(machine)
+        self._slots.add(machine)
+
+    def add_machines(self, cpus, count, memory=None):
+        """ Add @count identical machines of @cpus (and @memory, see Machine) """
+        memory = memory if memory is not None else 1000 * 2 * cpus
+        first = self._table.append(cpus, memory, count)
+        self._cpus += cpus * count
+        for n in xrange(first, first + count):
+            machine = Machine.view(self._table, n)
+            self._m.append(machine)
+            self._slots.add(machine)
 
     def __str__(self):
         return "\n".join([x.long() for x in self])
 
+    def close(self):
+        """ Release whatever the farm holds besides memory, nothing here """
+        pass
+
+    def get_state(self):
+        """ Everything needed to rebuild this farm with its groups and queue
+            as (meta, arrays): a dict of JSON-able values and one of NumPy
+            arrays, machines and jobs being stored a column per attribute.
+
+            The trace isn't saved, nor can a farm ranking with a callback.
+        """
+        ranking = self._jobsorter.spec()
+        if ranking is None:
+            raise BatchExcept("Only farms using one of %s or a combination "
+                              "of them can be saved" % ", ".join(sorted(rankings)))
+
+        n = self._table.size
+        arrays = dict(('machine_' + col, getattr(self._table, col)[:n])
+                      for col, _ in MachineTable._columns)
+
+        table = self.queue.table if self.queue is not None else JobTable()
+        rows = table.rows()
+        runtime = table.runtime[rows]
+        slotid = np.empty(len(rows), np.int64)
+        slotid.fill(-1)
+        pos = slotid.copy()
+
+        # Running jobs have their runtime, slot and place on their machine
+        # kept outside the table
+        for machine in self._m:
+            for p, job in enumerate(machine):
+                i = rows.searchsorted(job._handle)
+                runtime[i] = job.runtime
+                slotid[i] = job.slotid
+                pos[i] = p
+
+        # Completion time of each running job when event-driven
+        due = np.empty(len(rows))
+        due.fill(np.nan)
+        if self._completions is not None:
+            for when, _, (machine, job) in self._completions:
+                due[rows.searchsorted(job._handle)] = when
+
+        arrays.update({
+            'job_cpus': table.cpus[rows],
+            'job_memory': table.memory[rows],
+            'job_length': table.length[rows],
+            'job_runtime': runtime,
+            'job_state': table.state[rows],
+            'job_group': table.group[rows],
+            'job_slotid': slotid,
+            'job_node': table.node[rows],
+            'job_pos': pos,
+            'job_due': due,
+        })
+
+        meta = {
+            'ranking': ranking,
+            'time': self.time,
+            'quantum': self.quantum,
+            'event_driven': self._completions is not None,
+            'neg_stats': self.neg_stats,
+            'machine_names': [x.name for x in self._m],
+            'job_groups': table.group_names,
+            'groups': self.groups.get_state() if self.groups is not None else None,
+            'queue': self.queue is not None,
+        }
+        return meta, arrays
+
+    @classmethod
+    def from_state(cls, meta, arrays):
+        """ A new farm, with groups and queue, from the output of get_state() """
+        self = cls(meta['ranking'])
+        self.time = meta['time']
+        self.neg_stats.update(meta['neg_stats'])
+
+        names = meta['machine_names']
+        table = self._table
+        table.append(0, 0, len(names))
+        for col, _ in MachineTable._columns:
+            getattr(table, col)[:table.size] = arrays['machine_' + col]
+        self._cpus = int(table.totalcpus[:table.size].sum())
+        for number, name in enumerate(names):
+            machine = Machine.view(table, number, str(name))
+            self._m.append(machine)
+            self._slots.add(machine)
+
+        if meta['groups'] is not None:
+            self.attach_groups(Group.from_state(meta['groups']))
+        if not meta['queue']:
+            return self
+        queue = JobQueue()
+        self.attach_queue(queue)
+
+        table = queue.table
+        groups = np.array([table.group_id(str(x)) for x in meta['job_groups']], np.int32)
+        count = len(arrays['job_state'])
+        first = table.append(count, group=groups[arrays['job_group']] if count else 0,
+                             **dict((col, arrays['job_' + col]) for col in
+                                    ('cpus', 'memory', 'length', 'runtime', 'state', 'node')))
+        queue._added(first, count)
+
+        # Put running jobs back on their machines in the order they were in,
+        # the machines' resources are already accounted for in the table
+        node, pos = arrays['job_node'], arrays['job_pos']
+        running = np.flatnonzero(node >= 0)
+        running = running[np.lexsort((pos[running], node[running]))]
+        jobs = {}
+        for i in running.tolist():
+            machine = self._m[node[i]]
+            job = jobs[i] = queue._job(first + i)
+            job.slotid = arrays['job_slotid'].item(i)
+            job.current_node = machine.name
+            list.append(machine, job)
+            self._running.add(job, machine.number)
+
+        if meta['event_driven']:
+            self.quantum = meta['quantum']
+            self._completions = EventQueue()
+            due = arrays['job_due']
+            for i in running[np.argsort(due[running], kind='mergesort')].tolist():
+                self._completions.push(float(due[i]), COMPLETE,
+                                       (self._m[node[i]], jobs[i]))
+        return self
+
     def update_usage(self):
-        """ Update each group's usage by counting running jobs on the farm,
-            each non-leaf group has it's usage set by summing it's children
+        """ Each group's usage, demand and idle/running counts are kept up to
+            date as jobs are submitted, started and completed, so there is
+            nothing to recount here unless debug_counters is set.
         """
-        for grp in self.groups.active_groups():
-            jobs = self.queue.match_jobs({'group': grp.name, 'state': RUNNING})
-            grp.usage = sum(self.slotweight(x) for x in jobs)
+        if self.debug_counters:
+            self.check_counters()
 
-        for group in self.groups:
-            if group.children:
-                group.usage = sum(x.usage for x in group.children.values())
+    def _group(self, name):
+        """ The group @name counts towards, None if there's no such group or
+            no group tree attached yet
+        """
+        if self.groups is None:
+            return None
+        group = self.groups.find(name)
+        return group if group is not self.groups else None
+
+    def _job_changed(self, job, old, new):
+        """ Queue watcher keeping the group counters up to date, the usage
+            of a group counts its running jobs and demand its idle ones, each
+            non-leaf group's counters are the sum of its children's
+        """
+        group = self._group(job.group)
+        if group is None:
+            return
+
+        idle = (new == IDLE) - (old == IDLE)
+        running = (new == RUNNING) - (old == RUNNING)
+        if not idle and not running:
+            return
+        weight = self.slotweight(job)
+        group.add_counts(idle, idle * weight, running, running * weight)
+
+    def _jobs_changed(self, name, old, new, cpus):
+        """ Queue watcher for jobs added or moved in bulk, like _job_changed
+            for each
+        """
+        group = self._group(name)
+        if group is None:
+            return
+
+        idle = (new == IDLE) - (old == IDLE)
+        running = (new == RUNNING) - (old == RUNNING)
+        if not idle and not running:
+            return
+        jobs = len(cpus)
+        weight = int(cpus.sum())
+        group.add_counts(idle * jobs, idle * weight, running * jobs, running * weight)
+
+    def _count(self):
+        """ Recount (idle, demand, running, usage) per group from the queue """
+        counts = dict((x, [0, 0, 0, 0]) for x in self.groups)
+        counts[self.groups] = [0, 0, 0, 0]
+
+        for (name, state), (jobs, cpus) in self.queue.totals().iteritems():
+            if state not in (IDLE, RUNNING):
+                continue
+            group = self._group(name)
+            col = 0 if state == IDLE else 2
+            while group is not None:
+                counts[group][col] += jobs
+                counts[group][col + 1] += cpus
+                group = group.parent
+        return counts
+
+    def _reset_counters(self):
+        if self.groups is None or self.queue is None:
+            return
+        for group, c in self._count().iteritems():
+            group.idle, group.demand, group.running, group.usage = c
+
+    def check_counters(self):
+        """ Compare the live group counters to a full recount of the queue """
+        if self.groups is None or self.queue is None:
+            return
+        for group, c in self._count().iteritems():
+            live = [group.idle, group.demand, group.running, group.usage]
+            if live != c:
+                raise BatchExcept("Counters for %s are (idle, demand, running, "
+                                  "usage) %s, recount gives %s" %
+                                  (group.full_name(), live, c))
 
     def get_slots_fitting(self, job):
         """ Return all machines where this job could fit """
 
-        return (x for x in self if x.cpus >= job.cpus and x.memory >= job.memory)
+        fits = self._table.fitting(job.cpus, job.memory)
+        return (self._m[x] for x in np.flatnonzero(fits))
+
+    def best_slot(self, job):
+        """ Return the best ranked machine where this job could fit, or None.
+
+            Indexed rankings are looked up in the slot index or, if that is
+            turned off, scored for all machines at once like the others, with
+            the best fitting one picked by argmax. A callback ranking is
+            called for every fitting machine.
+        """
+        stats = self.neg_stats
+        policy = self._jobsorter
+        if self.use_slot_index and policy.indexed:
+            probes = self._slots.probes
+            best = policy.lookup(self._slots, job)
+            stats['machines_scanned'] += self._slots.probes - probes
+            return best
+
+        stats['machines_scanned'] += self._table.size
+        scores = policy.score(self._table, job)
+        if scores is not None:
+            fits = self._table.fitting(job.cpus, job.memory)
+            if not fits.any():
+                return None
+            ranked = np.where(fits, scores, -np.inf)
+            return self._m[ranked.argmax()]
+
+        try:
+            return max(self.get_slots_fitting(job), key=policy.keys(self._table, job))
+        except ValueError:
+            return None
+
+    def reset_neg_stats(self):
+        """ Zero the negotiation counters, which count over all cycles:
+
+            cycles              calls to negotiate_jobs
+            jobs_considered     idle jobs looked at
+            matches             jobs started
+            rejected            jobs skipped as they'd violate a quota
+            cycles_ended        group cycles ended early by quota/surplus
+            no_slot             allowed jobs no machine had room for
+            machines_scanned    machines looked at finding slots
+        """
+        self.neg_stats = dict.fromkeys(('cycles', 'jobs_considered', 'matches',
+                                        'rejected', 'cycles_ended', 'no_slot',
+                                        'machines_scanned'), 0)
+
+    def negotiation_stats(self):
+        """ The negotiation counters plus machines scanned per match """
+        stats = dict(self.neg_stats)
+        stats['scanned_per_match'] = (float(stats['machines_scanned']) /
+                                      max(stats['matches'], 1))
+        return stats
 
     def attach_queue(self, q):
         self.queue = q
+        q.watch(self._job_changed, self._jobs_changed)
+        self._reset_counters()
 
     def attach_groups(self, g):
         assert (self.groups is None)
         self.groups = g
+        self._reset_counters()
 
     def advance_time(self, step):
-        """ Advance time for each machine running a job, which in turn advances
-            time for each job on that machine
+        """ Advance time for all running jobs at once, then release the
+            resources held by the ones that finished
         """
-        for machine in self:
-            machine.advance_time(step)
+        running = self._running
+        done = running.advance(step)
+
+        # Going from the last row down, rows moved into the place of a
+        # finished job are never ones still waiting to be handled
+        for row in done[::-1]:
+            self._finish_job(self._m[running.node[row]], running.jobs[row])
         self.time += step
 
+    def _finish_job(self, machine, job):
+        self._running.remove(job)
+        job.finish()
+        log.info("Completed job %s on %s", job, machine)
+        machine.end_job(job)
+
+    def set_event_driven(self, enabled, quantum=0):
+        """ Switch between advancing time in fixed ticks (advance_time) and
+            jumping between job completions (advance_to).
+
+            With a @quantum completion times are rounded up to a multiple of
+            it, so a job finishes at the same time it would with ticks of that
+            size. Jobs already running are carried over in both directions.
+        """
+        if enabled:
+            self.quantum = quantum
+            self._completions = EventQueue()
+            for machine in self:
+                for job in machine:
+                    self._schedule_completion(machine, job)
+        elif self._completions is not None:
+            # Fold the remaining time back into the runtime the ticks expect
+            for when, _, (machine, job) in self._completions:
+                job.runtime = job.length - (when - self.time)
+            self._completions = None
+
+    def _schedule_completion(self, machine, job):
+        remaining = job.length - job.runtime
+        if self.quantum:
+            # A tick-based run needs at least one tick to finish any job
+            remaining = max(remaining, self.quantum)
+        when = quantize(self.time + remaining, self.quantum)
+        self._completions.push(when, COMPLETE, (machine, job))
+
+    def start_job(self, machine, job):
+        """ Start @job on @machine, scheduling its completion if needed. Jobs
+            have to be started through here for the farm to advance them.
+        """
+        machine.start_job(job)
+        self._running.add(job, machine.number)
+        if self._completions is not None:
+            self._schedule_completion(machine, job)
+
+    def start_jobs(self, machine, jobs):
+        """ Start all of @jobs on @machine, like start_job() for each """
+        machine.start_jobs(jobs)
+        for job in jobs:
+            self._running.add(job, machine.number)
+            if self._completions is not None:
+                self._schedule_completion(machine, job)
+
+    def next_completion(self):
+        """ Time of the next job completion (event-driven mode only) """
+        return self._completions.next_time()
+
+    def advance_to(self, time):
+        """ Jump forward to @time finishing all jobs due by then, the cost
+            is proportional to the number of completions, not farm size
+        """
+        events = self._completions
+        while events and events.next_time() <= time:
+            self.time, _, (machine, job) = events.pop()
+            job.runtime = job.length
+            self._finish_job(machine, job)
+        self.time = time
+
     def allowed_run(self, job, group, demand):
         """ Determine if a job is able to run in its group, accounting for quota
             usage and searching for surplus from parent groups if available and
@@ -118,16 +493,16 @@ class Farm(object):
         quota = group.norm_quota
         usage = group.usage
         name = group.name
+        trace = self.trace
 
         candidate_weight = self.slotweight(job)
         seek_surplus = False
 
-        go = 'try for surplus...' if group.accept_surplus else 'end.'
-
         # If job is over its usage...
         if usage >= quota:
-            log.info("Group %s usage(%d) >= quota(%d), %s",
-                     name, usage, quota, go)
+            if trace is not None:
+                trace.record(self.time, tr.OVER_QUOTA, name, usage, quota,
+                             group.accept_surplus)
             # ...and accept surplus is not set, end, otherwise set surplus flag
             if not group.accept_surplus:
                 raise EndNegCycle()
@@ -135,7 +510,9 @@ class Farm(object):
                 seek_surplus = True
         # Or if a job would put it's group over its quota...
         elif candidate_weight + usage > quota:
-            log.debug("Job '%s' would put '%s' over quota, %s", job, name, go)
+            if trace is not None:
+                trace.record(self.time, tr.WOULD_EXCEED, name, candidate_weight,
+                             usage, quota)
 
             # ...and accept surplus is not set, reject, otherwise set surplus flag
             if not group.accept_surplus:
@@ -144,41 +521,45 @@ class Farm(object):
                 seek_surplus = True
 
         if seek_surplus:
-            self.print_groups()
             avail_surplus = 0
 
             # Walk up tree of parents gathering surplus until the root is hit
             parent = group.parent
             while parent:
                 surplus = max(min(demand - avail_surplus, parent.surplus), 0)
-                log.info("Group %s allocated %d surplus from %s",
-                         name, surplus, parent.full_name())
+                if trace is not None:
+                    trace.record(self.time, tr.SURPLUS, name, surplus, parent.name)
                 avail_surplus += surplus
 
                 # We hit the root of the tree
                 if not parent.parent:
-                    log.info("Group %s no longer any surplus available", parent.full_name())
+                    if trace is not None:
+                        trace.record(self.time, tr.SURPLUS_ROOT, parent.name)
                     break
 
                 # Parent doesn't accept surplus
                 if not parent.accept_surplus:
-                    log.info("Group %s no longer accepts surplus", parent.full_name())
+                    if trace is not None:
+                        trace.record(self.time, tr.SURPLUS_STOP, parent.name)
                     break
 
                 parent = parent.parent
 
             # If surplus found allocate it and set the quota to the higher value
             if avail_surplus:
-                group.norm_quota += avail_surplus
+                group.grow_quota(avail_surplus)
                 quota = group.norm_quota
-                log.info("Surplus was found for %s (%d), quota now %d",
-                         name, avail_surplus, group.norm_quota)
+                if trace is not None:
+                    trace.record(self.time, tr.SURPLUS_FOUND, name, avail_surplus,
+                                 group.norm_quota)
             else:
-                log.info("No surplus available for %s, end.", name)
+                if trace is not None:
+                    trace.record(self.time, tr.NO_SURPLUS, name)
                 raise EndNegCycle()
 
             if candidate_weight + usage > quota:
-                log.info('Surplus was not sufficient for job, not matching')
+                if trace is not None:
+                    trace.record(self.time, tr.SURPLUS_SHORT, name)
                 raise JobWouldViolate()
 
         # If the group would violate the quota of its group or any of its
@@ -187,19 +568,21 @@ class Farm(object):
 
         return candidate_weight
 
-    @staticmethod
-    def violate_parent_quota(group, weight):
+    def violate_parent_quota(self, group, weight):
         """ Again walk up the tree of parents and see if the quota is violated
             by a candidate job
         """
+        trace = self.trace
         while group.parent:
             if group.usage >= group.norm_quota and not group.accept_surplus:
-                log.info("Group %s at quota %d (usage=%d)", group.full_name(),
-                         group.norm_quota, group.usage)
+                if trace is not None:
+                    trace.record(self.time, tr.PARENT_AT_QUOTA, group.name,
+                                 group.norm_quota, group.usage)
                 raise EndNegCycle()
             if group.usage + weight > group.norm_quota and not group.accept_surplus:
-                log.info("Weight of %d would put group %s over quota %d (usage=%d)",
-                         weight, group.full_name(), group.norm_quota, group.usage)
+                if trace is not None:
+                    trace.record(self.time, tr.PARENT_WOULD_EXCEED, group.name,
+                                 weight, group.norm_quota, group.usage)
                 raise JobWouldViolate()
             group = group.parent
         return weight
@@ -207,8 +590,11 @@ class Farm(object):
     def negotiate_jobs(self):
         """ Iterate over idle jobs and see if there are any matches for them """
 
-        log.info("=" * 85)
-        log.info("Negotiate with %d jobs", len([x for x in self.queue if x.state == IDLE]))
+        trace = self.trace
+        if trace is not None:
+            trace.record(self.time, tr.CYCLE, None, self.groups.idle)
+        stats = self.neg_stats
+        stats['cycles'] += 1
 
         # Recalculate actual quotas if they've been adjusted by the user
         self.groups.update_quota(self)
@@ -216,19 +602,23 @@ class Farm(object):
         self.update_usage()
 
         for group in self.groups:
-            jobs = self.queue.match_jobs({"group": group.name, "state": IDLE})
             group.orig_quota = group.norm_quota
 
-            # Demand is number of idle jobs in the queue
-            group.demand = sum(self.slotweight(x) for x in jobs)
-
             # If the quota appears to be exceeded but accept_surplus is set,
             # make the new quota higher (set equal to usage) so if more surplus
             # is allocated things are counted correctly
             if group.usage > group.norm_quota and group.accept_surplus:
                 group.norm_quota = group.usage
 
-        self.print_groups()
+        if trace is not None:
+            self.trace_groups()
+
+        # From here on the surplus is kept up to date as jobs start and
+        # groups take surplus, and only needs syncing for the changed groups
+        self.groups.update_surplus()
+
+        # (cpus, memory) of jobs found not to fit anywhere this cycle
+        self._no_fit = []
 
         # For each group in correct order...
         for group in self.sort_groups_by_usage():
@@ -236,50 +626,141 @@ class Farm(object):
             usage = group.usage
             quota = group.norm_quota
             demand = group.demand
-            self.groups.update_surplus()
+            self.groups.sync_surplus()
 
             if demand == 0:
-                log.info("No jobs for group %s, skip negotiating", name)
+                if trace is not None:
+                    trace.record(self.time, tr.SKIP, name)
                 continue
 
-            log.info("Negotiate for %s: usage=%d quota=%d demand=%d", name, usage, quota, demand)
-            self.print_groups()
+            if trace is not None:
+                trace.record(self.time, tr.GROUP, name, usage, quota, demand)
 
-            # For each candidate idle-job in that group...
-            for job in self.queue.match_jobs({"group": name, "state": IDLE}):
-
-                # See if the job is allowed to run...
+            # For each autocluster of idle jobs of one shape in that group...
+            try:
+                for cpus, memory, rows in self.queue.autoclusters(name):
+                    self.negotiate_cluster(group, demand, cpus, memory, rows)
+            except EndNegCycle:
+                stats['cycles_ended'] += 1
+            else:
+                if trace is not None:
+                    trace.record(self.time, tr.EXHAUSTED, name)
+
+    def negotiate_cluster(self, group, demand, cpus, memory, rows):
+        """ Match the idle jobs of @group at table @rows, all of @cpus and
+            @memory, raising EndNegCycle when the group is done.
+
+            The jobs are alike, so as many as the headroom() of the group
+            allows are admitted at once without going through allowed_run(),
+            and placed together by place_jobs(). Once one job finds no slot
+            all the rest would not either, and once one is rejected without
+            the quota changing so would the rest be, so they are counted in
+            one go. Shapes finding no slot are remembered for the rest of the
+            cycle.
+        """
+        stats = self.neg_stats
+        trace = self.trace
+        name = group.name
+        queue = self.queue
+        weight = self.slotweight(queue._job(rows.item(0)))
+        no_fit = self._no_fit
+        i = 0
+
+        while i < len(rows):
+            # See if the jobs are allowed to run...
+            batch = min(self.headroom(group, weight), len(rows) - i)
+            if batch:
+                stats['jobs_considered'] += batch
+            else:
+                # ...one at a time once that takes surplus
+                stats['jobs_considered'] += 1
+                quota = group.norm_quota
                 try:
-                    weight = self.allowed_run(job, group, demand)
+                    self.allowed_run(queue._job(rows.item(i)), group, demand)
                 except JobWouldViolate:
+                    stats['rejected'] += 1
+                    i += 1
+                    if trace is None and group.norm_quota == quota:
+                        stats['jobs_considered'] += len(rows) - i
+                        stats['rejected'] += len(rows) - i
+                        return
                     continue
-                except EndNegCycle:
-                    break
-
-                # Of all slots where job could fit...
-                matching = self.get_slots_fitting(job)
-
-                # ...find the one with the best rank
-                try:
-                    best = max(matching, key=self._jobsorter)
-                except ValueError:
-                    log.info("No slots found matching job %s", job)
-                    continue
+                batch = 1
 
-                log.info("Matched job '%s' to slot '%s'", job, best)
-
-                # State the job
-                best.start_job(job)
-
-                # Update the usage / surplus of the group and all parents up the tree
-                group.usage += weight
-                parent = group.parent
-                while parent:
-                    parent.usage += weight
-                    parent.surplus -= weight
-                    parent = parent.parent
+            # Of all slots where the jobs could fit find the best ranked
+            if any(cpus >= c and memory >= m for c, m in no_fit):
+                placed = []
             else:
-                log.info("No more jobs submitted for group %s", name)
+                placed = self.place_jobs(list(queue._jobs(rows[i:i + batch])))
+            started = 0
+            for machine, count in placed:
+                if trace is not None:
+                    for _ in xrange(count):
+                        trace.record(self.time, tr.MATCH, name, cpus, memory,
+                                     machine.name)
+                started += count
+            stats['matches'] += started
+            i += started
+
+            # Usage was counted as the jobs started, update the surplus of
+            # all parents up the tree
+            parent = group.parent
+            while parent:
+                parent.surplus -= weight * started
+                parent = parent.parent
+
+            if started < batch:
+                # The rest are admitted or not but can't fit, taking no quota
+                left = len(rows) - i
+                stats['no_slot'] += left
+                stats['jobs_considered'] += left - (batch - started)
+                no_fit.append((cpus, memory))
+                if trace is not None:
+                    for _ in xrange(left):
+                        trace.record(self.time, tr.NO_SLOT, name, cpus, memory)
+                return
+
+    def place_jobs(self, jobs):
+        """ Start as many of @jobs, all of the same shape, as fit, in order,
+            each on the best ranked slot, returning a list of (machine,
+            number of jobs started on it) in the order they were started.
+
+            With a ranking that fills machines the best machine stays the
+            best for the next job until it is full, so it is given as many
+            jobs as fit in one go, looking up one machine per machine filled
+            rather than per job.
+        """
+        placed = []
+        cpus, memory = jobs[0].cpus, jobs[0].memory
+        fills = self._jobsorter.fills
+        i = 0
+        while i < len(jobs):
+            best = self.best_slot(jobs[i])
+            if best is None:
+                break
+            count = 1
+            if fills:
+                count = min(len(jobs) - i, best.cpus // cpus)
+                if memory > 0:
+                    count = min(count, int(best.memory // memory))
+            self.start_jobs(best, jobs[i:i + count])
+            placed.append((best, count))
+            i += count
+        return placed
+
+    def headroom(self, group, weight):
+        """ How many jobs of @weight allowed_run() lets @group start, one
+            after the other, without looking for surplus
+        """
+        if weight <= 0:
+            return 0
+        room = (group.norm_quota - group.usage) // weight
+        parent = group.parent
+        while parent is not None and parent.parent is not None:
+            if not parent.accept_surplus:
+                room = min(room, (parent.norm_quota - parent.usage) // weight)
+            parent = parent.parent
+        return max(int(room), 0)
 
     def sort_groups_by_usage(self):
         """ Return group and usage in "starvation" order, least used to most. """
@@ -287,7 +768,9 @@ class Farm(object):
         groups = list(self.groups.active_groups())
         groups = [(x, float(x.usage) / x.orig_quota, x.name) for x in groups]
         groups.sort(key=lambda x: x[1])
-        log.info([x[1:] for x in groups])
+        if self.trace is not None:
+            for grp, ratio, name in groups:
+                self.trace.record(self.time, tr.ORDER, name, ratio)
 
         return (x[0] for x in groups)
 
@@ -296,3 +779,8 @@ class Farm(object):
             log.info("%s: usage=%d quota=%d(%d) demand=%d surplus=%d", x.full_name(),
                      x.usage, x.norm_quota, x.quota, x.demand, x.surplus)
 
+    def trace_groups(self):
+        for x in self.groups:
+            self.trace.record(self.time, tr.STATE, x.name, x.usage, x.norm_quota,
+                              x.quota, x.demand, x.surplus)
+
@@ -1,17 +1,86 @@
 #!/usr/bin/python
 
+import numpy as np
+
+
+def _gauss(rng, grp, n):
+    # Negative lengths are folded back, like abs(random.gauss(avg, std))
+    return np.abs(rng.normal(grp.avg, grp.std, n))
+
+
+def _lognormal(rng, grp, n):
+    # Pick the underlying normal so the lengths have mean avg and stddev std
+    sigma2 = np.log(1 + (float(grp.std) / grp.avg) ** 2)
+    return rng.lognormal(np.log(grp.avg) - sigma2 / 2, np.sqrt(sigma2), n)
+
+
+def _exponential(rng, grp, n):
+    return rng.exponential(grp.avg, n)
+
+
+def _empirical(rng, grp, n):
+    return rng.choice(grp.samples, n)
+
+# Distributions job lengths can be drawn from, see Group.set_character
+length_distributions = {
+    'gauss': _gauss,
+    'lognormal': _lognormal,
+    'exponential': _exponential,
+    'empirical': _empirical,
+}
+
+
+# Attributes saved by Group.get_state, the job counters (idle, running, usage
+# and demand) are left out as the farm recounts them from the queue
+_state_attrs = ('quota', 'accept_surplus', 'norm_quota', 'orig_quota', 'surplus',
+                'num', 'cpu', 'mem', 'avg', 'std', 'dist')
+
+
+class _TreeIndex(object):
+    """ Flattened view of the groups below one group: pre-order (the order
+        Group.walk goes in) and post-order lists, the leaves with a quota and
+        a name to group map, where the first group in pre-order wins.
+    """
+
+    __slots__ = ['walk', 'postorder', 'active', 'by_name', 'norm', 'norm_size']
+
+    def __init__(self, group):
+        self.walk = []
+        self.postorder = []
+        for x in group.children.values():
+            sub = x._tree()
+            self.walk.append(x)
+            self.walk.extend(sub.walk)
+            self.postorder.extend(sub.postorder)
+            self.postorder.append(x)
+        self.active = [x for x in self.walk if x.quota > 0]
+        self.by_name = {}
+        for x in reversed(self.walk):
+            self.by_name[x.name] = x
+
+        # Normalized quotas in walk order for a farm of norm_size cpus
+        self.norm = None
+        self.norm_size = None
+
 
 class Group(object):
     """ A tree of scheduling groups. Leaf nodes are groups where jobs are
         actually submitted, mid-level nodes set limits on the surplus-sharing
         abilities of this tree of groups.
+
+        Each group keeps an index of the groups below it, built when first
+        needed and dropped, for the group and all above it, when a child is
+        added or a quota or surplus flag changes.
     """
 
     def __init__(self, name, quota=0, surplus=False):
+        self._index = None
+        self._full_name = None
+        self.parent = None
+
         # These variables define the nature of the group, and are explicitly set
         self.name = name
         self.quota = quota
-        self.parent = None
         self.accept_surplus = surplus
         self.children = {}
 
@@ -21,80 +90,245 @@ class Group(object):
         self.usage = 0
         self.surplus = 0
 
+        # Live counts of this group's jobs, including all its children's
+        self.idle = 0
+        self.running = 0
+
+        # Sum of norm_quota - usage of the groups with a quota below this
+        # one, kept up to date between calls to update_surplus()
+        self._slack = 0
+        self._dirty = False
+        # Groups whose _slack changed since update_surplus, on the top group
+        self._changed = []
+
+    def _invalidate(self):
+        group = self
+        while group is not None:
+            group._index = None
+            group = group.parent
+
+    def _tree(self):
+        if self._index is None:
+            self._index = _TreeIndex(self)
+        return self._index
+
+    @property
+    def quota(self):
+        return self._quota
+
+    @quota.setter
+    def quota(self, value):
+        self._quota = value
+        self._invalidate()
+
+    @property
+    def accept_surplus(self):
+        return self._accept_surplus
+
+    @accept_surplus.setter
+    def accept_surplus(self, value):
+        self._accept_surplus = value
+        self._invalidate()
+
+    def _attach(self, child):
+        child.parent = self
+        child._full_name = None
+        self.children[child.name] = child
+        self._invalidate()
+
     def add_child(self, name, quota=0, surplus=False):
         """ Add a child node to this one, setting it's parent pointer """
 
-        new = Group(name, quota=quota, surplus=surplus)
-        new.parent = self
-        self.children[name] = new
+        self._attach(Group(name, quota=quota, surplus=surplus))
 
-    def set_character(self, num=0, cpu=1, mem=None, avg=3600, std=600):
+    def set_character(self, num=0, cpu=1, mem=None, avg=3600, std=600,
+                      dist='gauss', samples=None):
         """ Sets the characteristic properties of jobs submitted into this
             group, such as number of cpus, average length, etc...
+
+            Job lengths are drawn from @dist, one of length_distributions:
+            'gauss' and 'lognormal' use @avg and @std, 'exponential' only
+            @avg and 'empirical' picks from the observed lengths in @samples
         """
+        if dist not in length_distributions:
+            raise ValueError("Unknown length distribution %s" % dist)
+        if dist == 'empirical' and not len(samples):
+            raise ValueError("Empirical distribution needs samples")
+
         self.num = num
         self.cpu = cpu
         self.mem = mem if mem is not None else cpu * 2000
         self.avg = avg
         self.std = std
+        self.dist = dist
+        self.samples = np.asarray(samples) if samples is not None else None
+
+    def draw_lengths(self, rng, n):
+        """ Array of @n job lengths drawn with numpy RandomState @rng """
+        return length_distributions[self.dist](rng, self, n)
+
+    def get_state(self):
+        """ This group and all below it as plain (JSON-able) data """
+        state = dict((k, getattr(self, k)) for k in _state_attrs if hasattr(self, k))
+        state['name'] = self.name
+        if getattr(self, 'samples', None) is not None:
+            state['samples'] = self.samples.tolist()
+        # A list, so the children come back in the order they're walked now
+        state['children'] = [x.get_state() for x in self.children.values()]
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """ Rebuild a group tree from the output of get_state() """
+        self = cls(str(state['name']))
+        for k in _state_attrs:
+            if k in state:
+                v = state[k]
+                setattr(self, k, str(v) if isinstance(v, unicode) else v)
+        if 'dist' in state:
+            samples = state.get('samples')
+            self.samples = np.asarray(samples) if samples is not None else None
+        for child in state['children']:
+            self._attach(cls.from_state(child))
+        return self
 
     def full_name(self):
-        names = list()
-        parent = self
-        while parent is not None:
-            names.append(parent.name)
-            parent = parent.parent
-        return ".".join(reversed(names))
+        if self._full_name is None:
+            if self.parent is None:
+                self._full_name = self.name
+            else:
+                self._full_name = self.parent.full_name() + "." + self.name
+        return self._full_name
 
     def walk(self):
-        """ Recursively iterate through all lower nodes in the tree """
-        if not self.children:
-            return
-        for x in self.children.values():
-            yield x
-            for y in x.walk():
-                yield y
+        """ Iterate through all lower nodes in the tree, depth first """
+        return iter(self._tree().walk)
 
-    def get_by_name(self, name):
+    def postorder(self):
+        """ All lower nodes in the tree, each one after its children """
+        return iter(self._tree().postorder)
+
+    def find(self, name):
+        """ The group called @name, this one or one below it, or None """
         if self.name == name:
             return self
-        for x in self.walk():
-            if name == x.name:
-                return x
-        raise Exception("No group %s found" % name)
+        return self._tree().by_name.get(name)
+
+    def get_by_name(self, name):
+        group = self.find(name)
+        if group is None:
+            raise Exception("No group %s found" % name)
+        return group
 
     def names(self):
         return (x.name for x in self)
 
     def active_groups(self):
         """ Active groups are leaf nodes -- i.e. nodes with a quota """
-        return (x for x in self if x.quota > 0)
+        return iter(self._tree().active)
 
     def __getitem__(self, key):
         return self.children[key]
 
     def update_quota(self, farm):
         """ Recalculate the actual quotas for each group, based on a farm of
-            a given size.
+            a given size. They are only worked out again when the quotas or
+            farm size changed since last time.
         """
-        total = sum(x.quota for x in self)
         size = farm.count_cpus()
+        index = self._tree()
+
+        if index.norm_size != size:
+            total = sum(x.quota for x in self)
+
+            # First calculate quota for leaf nodes (groups with .quota > 0)
+            for grp in self:
+                # will be 0 for non-leaf nodes
+                my_quota = int(round((float(grp.quota) / total) * size))
+                grp.norm_quota = my_quota
 
-        # First calculate quota for leaf nodes (groups with .quota > 0)
-        for grp in self:
-            # will be 0 for non-leaf nodes
-            my_quota = int(round((float(grp.quota) / total) * size))
-            grp.norm_quota = my_quota
+            # Now set intermediate nodes to have quotas=sum of all children,
+            # going up from the bottom each child's quota already includes its own
+            for grp in self.postorder():
+                grp.norm_quota += sum(x.norm_quota for x in grp.children.values())
 
-        # Now set intermediate nodes to have quotas=sum of all children
-        for grp in self:
-            child_quotas = sum(x.norm_quota for x in grp)
-            grp.norm_quota += child_quotas
+            index.norm = [x.norm_quota for x in index.walk]
+            index.norm_size = size
+
+        for grp, quota in zip(index.walk, index.norm):
+            grp.norm_quota = quota
 
     def update_surplus(self):
-        """ Surplus is un-used slots by a groups children """
-        for sub in self:
-            sub.surplus = sum(x.norm_quota - x.usage for x in sub if x.quota > 0)
+        """ Surplus is un-used slots by a groups children. After working it
+            out for all groups below this one it is kept up to date as job
+            counts (add_counts) and quotas (grow_quota) change, so that
+            sync_surplus() can bring it up to date again where needed.
+        """
+        for sub in self.postorder():
+            sub._slack = sum(x._slack + (x.norm_quota - x.usage if x.quota > 0 else 0)
+                             for x in sub.children.values())
+            sub.surplus = sub._slack
+
+        top = self._top()
+        for x in top._changed:
+            x._dirty = False
+        top._changed = []
+
+    def sync_surplus(self):
+        """ Same as update_surplus(), called on the top of the tree, but only
+            touching the groups whose surplus changed since
+        """
+        for x in self._changed:
+            x.surplus = x._slack
+            x._dirty = False
+        self._changed = []
+
+    def _top(self):
+        group = self
+        while group.parent is not None:
+            group = group.parent
+        return group
+
+    def _add_slack(self, amount):
+        # Add to the slack of this group and all above it but the top
+        changed = []
+        group = self
+        while group.parent is not None:
+            group._slack += amount
+            if not group._dirty:
+                group._dirty = True
+                changed.append(group)
+            group = group.parent
+        group._changed.extend(changed)
+
+    def grow_quota(self, amount):
+        """ Raise norm_quota by @amount """
+        self.norm_quota += amount
+        if self.quota > 0 and self.parent is not None:
+            self.parent._add_slack(amount)
+
+    def add_counts(self, idle, demand, running, usage):
+        """ Add to the job counters of this group and all above it """
+        slack = 0
+        changed = []
+        group = self
+        while True:
+            group.idle += idle
+            group.demand += demand
+            group.running += running
+            group.usage += usage
+            if group.parent is None:
+                break
+            if slack:
+                group._slack += slack
+                if not group._dirty:
+                    group._dirty = True
+                    changed.append(group)
+            # The usage of a group with a quota counts against all above it
+            if group._quota > 0:
+                slack -= usage
+            group = group.parent
+        group._changed.extend(changed)
 
     def __repr__(self):
         return '<0x%x> %s (%d)' % (id(self), self.name, self.quota)
@@ -103,7 +337,7 @@ class Group(object):
         return iter(self.walk())
 
     def __contains__(self, key):
-        return (len([x.name for x in self if x.name == key]) > 0)
+        return key in self._tree().by_name
 
     def __str__(self):
         return '%s: surplus %s, quota %d, num %d' % \
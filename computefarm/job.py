@@ -1,35 +1,212 @@
 #!/usr/bin/python
 
+import numpy as np
+
 from computefarm import COMPLETED, IDLE, RUNNING
 
 
+# State of a JobTable row whose job has left the table
+FREE = -1
+
+
+class JobTable(object):
+    """ Columnar storage of jobs, one row per job with its attributes in
+        NumPy arrays (the group as an index into group_names), so a queue of
+        millions of idle jobs takes tens of bytes per job. Inside the table a
+        job is just its row number, BatchJob objects are views of a row.
+
+        Rows are handed out in order. Freed rows are reclaimed, once the
+        arrays are full, by compacting the table which keeps the remaining
+        rows in the same order but renumbers them: the views in pinned are
+        moved along, any other view of the table becomes invalid and epoch
+        is increased.
+    """
+
+    _columns = (('cpus', np.int32), ('memory', np.float64), ('group', np.int32),
+                ('length', np.float64), ('runtime', np.float64),
+                ('state', np.int8), ('node', np.int32))
+
+    def __init__(self, capacity=16):
+        self.size = 0
+        self.live = 0
+        self.epoch = 0
+        for col, dtype in self._columns:
+            setattr(self, col, np.zeros(capacity, dtype))
+        self.group_names = []
+        self._group_ids = {}
+
+        # {row: BatchJob} of views that must stay valid when rows move
+        self.pinned = {}
+
+    def group_id(self, name):
+        try:
+            return self._group_ids[name]
+        except KeyError:
+            n = self._group_ids[name] = len(self.group_names)
+            self.group_names.append(name)
+            return n
+
+    def _reserve(self, n):
+        capacity = len(self.cpus)
+        if self.size + n <= capacity:
+            return
+        # Compacting costs a pass over the table, so only do it when that
+        # frees a good share of it
+        if 4 * (self.size - self.live) >= self.size:
+            self.compact()
+            if self.size + n <= capacity:
+                return
+        while capacity < self.size + n:
+            capacity *= 2
+        for col, dtype in self._columns:
+            old = getattr(self, col)
+            new = np.zeros(capacity, dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, col, new)
+
+    def append(self, count, **values):
+        """ Add @count rows, each column given in @values being set to one
+            value or an array of @count, returning the first row. Columns
+            not given are 0, except node which is -1.
+        """
+        self._reserve(count)
+        first = self.size
+        rows = slice(first, first + count)
+        for col, _ in self._columns:
+            getattr(self, col)[rows] = values.get(col, -1 if col == 'node' else 0)
+        self.size += count
+        self.live += count
+        return first
+
+    def free(self, row):
+        self.state[row] = FREE
+        self.live -= 1
+
+    def rows(self):
+        """ Array of the rows in use, in order """
+        return np.flatnonzero(self.state[:self.size] != FREE)
+
+    def compact(self):
+        """ Drop the freed rows, moving the others up """
+        keep = self.rows()
+        for col, _ in self._columns:
+            column = getattr(self, col)
+            column[:len(keep)] = column[keep]
+
+        moved = np.zeros(self.size, np.int64)
+        moved[keep] = np.arange(len(keep))
+        pinned = {}
+        for row, job in self.pinned.iteritems():
+            job._handle = moved.item(row)
+            pinned[job._handle] = job
+        self.pinned = pinned
+        self.size = len(keep)
+        self.epoch += 1
+
+
+def _field(col, doc):
+    def get(self):
+        return getattr(self._table, col).item(self._handle)
+
+    def set(self, value):
+        getattr(self._table, col)[self._handle] = value
+    return property(get, set, doc=doc)
+
+
 class BatchJob(object):
-    """ Class representing one job for the batch system """
+    """ Class representing one job for the batch system, its attributes are a
+        row of a JobTable: its queue's table once it is queued.
+    """
 
-    __slots__ = ['cpus', 'memory', 'group', 'length', 'current_node',
-                 'slotid', 'state', 'runtime', 'queue']
+    __slots__ = ['current_node', 'slotid', 'queue', '_table', '_handle',
+                 '_running', '_row']
+
+    cpus = _field('cpus', "Cpus requested")
+    memory = _field('memory', "Memory requested")
+    length = _field('length', "Time the job runs for")
+    node = _field('node', "Number of the machine running the job or -1")
 
     def __init__(self, cpus=1, memory=None, group="grid", length=3600):
 
-        self.cpus = cpus if cpus else 1
-        self.memory = memory if memory is not None else self.cpus * 2000
-        self.group = group
-        self.length = length
+        cpus = cpus if cpus else 1
+        memory = memory if memory is not None else cpus * 2000
+
+        # Until the job is queued it has a table of its own
+        self._table = JobTable(1)
+        self._handle = self._table.append(1, cpus=cpus, memory=memory, length=length,
+                                          group=self._table.group_id(group), state=IDLE)
 
         self.current_node = None
         self.slotid = None
-        self.state = IDLE
-        self.runtime = 0
         self.queue = None
 
+        # While running on a farm the runtime lives in row _row of a RunningJobs
+        self._running = None
+        self._row = None
+
+    @classmethod
+    def view(cls, table, handle, queue=None):
+        """ BatchJob for row @handle of an existing @table """
+        self = cls.__new__(cls)
+        self._table = table
+        self._handle = handle
+        self.queue = queue
+        self.current_node = self.slotid = None
+        self._running = self._row = None
+        return self
+
+    def move_to(self, table):
+        """ Copy this job into a new row of @table and use that from now on """
+        old, n = self._table, self._handle
+        self._handle = table.append(1, **dict(
+            (col, getattr(old, col)[n]) for col, _ in JobTable._columns if col != 'group'))
+        table.group[self._handle] = table.group_id(old.group_names[old.group[n]])
+        self._table = table
+
+    @property
+    def group(self):
+        return self._table.group_names[self._table.group[self._handle]]
+
+    @group.setter
+    def group(self, value):
+        self._table.group[self._handle] = self._table.group_id(value)
+
+    @property
+    def runtime(self):
+        if self._row is None:
+            return self._table.runtime.item(self._handle)
+        return self._running.runtime.item(self._row)
+
+    @runtime.setter
+    def runtime(self, value):
+        if self._row is None:
+            self._table.runtime[self._handle] = value
+        else:
+            self._running.runtime[self._row] = value
+
+    @property
+    def state(self):
+        return self._table.state.item(self._handle)
+
+    @state.setter
+    def state(self, value):
+        # Let the queue account for the job's new state
+        if self.queue is not None:
+            self.queue.move(self, self.state, value)
+        self._table.state[self._handle] = value
+
     def advance_time(self, step):
         """ Advance time for the individual job, if it exceeds the runtime
             of the job then mark it completed and remove it from the queue
         """
         self.runtime += step
         if self.runtime >= self.length:
-            self.state = COMPLETED
-            self.queue.remove(self)
+            self.finish()
+
+    def finish(self):
+        """ Mark the job completed and remove it from its queue """
+        self.state = COMPLETED
+        self.queue.remove(self)
 
     def state_char(self):
         return ['I', 'R', 'C'][self.state]
@@ -46,3 +223,70 @@ class BatchJob(object):
         if self.current_node and self.slotid is not None:
             s += "   (%s@%s)" % (self.slotid, self.current_node)
         return s
+
+
+class RunningJobs(object):
+    """ The runtimes and lengths of all jobs running on a farm, kept in
+        contiguous arrays so that time can be advanced for every one of them
+        with a single vectorized operation. Row n holds jobs[n] running on
+        machine number node[n]; rows are kept packed by moving the last row
+        into the one a finished job leaves behind.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.runtime = np.zeros(capacity)
+        self.length = np.zeros(capacity)
+        self.node = np.zeros(capacity, np.int64)
+        self.jobs = []
+
+    def _grow(self):
+        capacity = 2 * len(self.runtime)
+        for col in ('runtime', 'length', 'node'):
+            old = getattr(self, col)
+            new = np.zeros(capacity, old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, col, new)
+
+    def add(self, job, node):
+        if self.size == len(self.runtime):
+            self._grow()
+        n = self.size
+        self.runtime[n] = job.runtime
+        self.length[n] = job.length
+        self.node[n] = node
+        self.jobs.append(job)
+        job._running = self
+        job._row = n
+        self.size += 1
+
+    def remove(self, job):
+        """ Take @job out of the table, leaving its runtime on the job """
+        n = job._row
+        last = self.size - 1
+        runtime = self.runtime[n]
+
+        if n != last:
+            moved = self.jobs[last]
+            self.runtime[n] = self.runtime[last]
+            self.length[n] = self.length[last]
+            self.node[n] = self.node[last]
+            self.jobs[n] = moved
+            moved._row = n
+
+        self.jobs.pop()
+        self.size = last
+        job._running = job._row = None
+        job.runtime = runtime
+
+    def advance(self, step):
+        """ Add @step to every runtime and return the rows of the jobs that
+            reached their length, in ascending order
+        """
+        n = self.size
+        runtime = self.runtime[:n]
+        runtime += step
+        return np.flatnonzero(runtime >= self.length[:n])
+
+    def __len__(self):
+        return self.size
@@ -3,31 +3,123 @@
 import logging
 import itertools
 
-from computefarm import COMPLETED, RUNNING
+import numpy as np
+
+from computefarm import RUNNING
 
 log = logging.getLogger('sim')
 
 
+class MachineTable(object):
+    """ Columnar storage of machine resources, one row per machine with the
+        free and total cpus and memory and the number of jobs running in
+        NumPy arrays. Arrays grow by doubling as machines are added, so
+        always index them with the current array rather than a saved one.
+    """
+
+    _columns = (('cpus', np.int64), ('totalcpus', np.int64),
+                ('memory', np.float64), ('totalmemory', np.float64),
+                ('num_jobs', np.int64))
+
+    def __init__(self, capacity=16):
+        self.size = 0
+        for col, dtype in self._columns:
+            setattr(self, col, np.zeros(capacity, dtype))
+
+    def _reserve(self, n):
+        capacity = len(self.cpus)
+        if self.size + n <= capacity:
+            return
+        while capacity < self.size + n:
+            capacity *= 2
+        for col, dtype in self._columns:
+            old = getattr(self, col)
+            new = np.zeros(capacity, dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, col, new)
+
+    def append(self, cpus, memory, count=1):
+        """ Add @count empty machines of @cpus and @memory, returning the
+            number of the first one
+        """
+        self._reserve(count)
+        first = self.size
+        rows = slice(first, first + count)
+        self.cpus[rows] = self.totalcpus[rows] = cpus
+        self.memory[rows] = self.totalmemory[rows] = memory
+        self.num_jobs[rows] = 0
+        self.size += count
+        return first
+
+    def fitting(self, cpus, memory):
+        """ Boolean mask of machines with at least @cpus and @memory free """
+        n = self.size
+        return (self.cpus[:n] >= cpus) & (self.memory[:n] >= memory)
+
+
+def _column(col, doc):
+    def get(self):
+        return getattr(self._table, col)[self.number]
+
+    def set(self, value):
+        getattr(self._table, col)[self.number] = value
+    return property(get, set, doc=doc)
+
+
 class Machine(list):
-    """ Class representing one machine in a compute cluster """
+    """ Class representing one machine in a compute cluster, the list holds
+        the jobs running on it while its resources are a row of a
+        MachineTable shared by all machines of the farm.
+    """
 
     _ids = itertools.count(0)
 
-    __slots__ = ['name', 'cpus', 'totalcpus', 'memory', 'totalmemory',
-                 'num_jobs']
+    __slots__ = ['name', 'number', 'slot_index', '_table']
+
+    cpus = _column('cpus', "Free cpus")
+    totalcpus = _column('totalcpus', "Total cpus")
+    memory = _column('memory', "Free memory")
+    totalmemory = _column('totalmemory', "Total memory")
+    num_jobs = _column('num_jobs', "Number of running jobs")
 
     def __init__(self, cpus=24, memory=None, name=None):
         """ Machines have two resources, CPUs, and RAM """
 
         self.name = name if name else "node%04d" % self._ids.next()
 
-        self.cpus = cpus
-        self.totalcpus = cpus
-
         # Ram defaults to 2Gb * Cores just like in our farm
-        self.memory = memory if memory is not None else 1000 * 2 * cpus
-        self.totalmemory = self.memory
-        self.num_jobs = 0.0
+        memory = memory if memory is not None else 1000 * 2 * cpus
+
+        # Until the machine is added to a farm it has a table of its own
+        self._table = MachineTable(1)
+        self.number = self._table.append(cpus, memory)
+
+        # Set when the machine is added to a farm's SlotIndex
+        self.slot_index = None
+
+    @classmethod
+    def view(cls, table, number, name=None):
+        """ Machine for row @number of an existing @table """
+        self = cls.__new__(cls)
+        self.name = name if name else "node%04d" % cls._ids.next()
+        self._table = table
+        self.number = number
+        self.slot_index = None
+        return self
+
+    def move_to(self, table):
+        """ Copy this machine's resources into a new row of @table and use
+            that from now on
+        """
+        n = table.append(self.totalcpus, self.totalmemory)
+        for col, _ in MachineTable._columns:
+            getattr(table, col)[n] = getattr(self._table, col)[self.number]
+        self._table = table
+        self.number = n
+
+    def _reindex(self, old_cpus, old_memory):
+        if self.slot_index is not None:
+            self.slot_index.update(self, old_cpus, old_memory)
 
     def start_job(self, job):
         """ Start a job by deducting the job's requested resources form this
@@ -37,33 +129,56 @@ class Machine(list):
         if self.cpus - job.cpus < 0 or self.memory - job.memory < 0:
             raise Exception("Bad match, machine %s has too few resources to run %s" % (self, job))
 
+        old_cpus, old_memory = self.cpus, self.memory
         self.cpus -= job.cpus
         self.memory -= job.memory
+        self._reindex(old_cpus, old_memory)
 
         job.slotid = len(self)
         job.state = RUNNING
         job.current_node = self.name
+        job.node = self.number
 
         self.append(job)
         self.num_jobs += 1
 
+    def start_jobs(self, jobs):
+        """ Start all of @jobs, of one group and in one queue, updating the
+            resources, the slot index and the queue once for all of them
+        """
+        cpus = sum(job.cpus for job in jobs)
+        memory = sum(job.memory for job in jobs)
+        if self.cpus - cpus < 0 or self.memory - memory < 0:
+            raise Exception("Bad match, machine %s has too few resources to run %d jobs" %
+                            (self, len(jobs)))
+
+        old_cpus, old_memory = self.cpus, self.memory
+        self.cpus -= cpus
+        self.memory -= memory
+        self._reindex(old_cpus, old_memory)
+
+        queue = jobs[0].queue
+        if queue is not None:
+            queue.move_jobs(jobs, RUNNING)
+        for job in jobs:
+            job.slotid = len(self)
+            if queue is None:
+                job.state = RUNNING
+            job.current_node = self.name
+            job.node = self.number
+            self.append(job)
+        self.num_jobs += len(jobs)
+
     def end_job(self, job):
         """ Finish a job by recovering the resources used by the job """
 
+        old_cpus, old_memory = self.cpus, self.memory
         self.cpus += job.cpus
         self.memory += job.memory
+        self._reindex(old_cpus, old_memory)
         self.remove(job)
         self.num_jobs -= 1
 
-    def advance_time(self, step):
-        """ Advance simulation time for each job in this machine """
-
-        for job in self:
-            job.advance_time(step)
-            if job.state == COMPLETED:
-                log.info("Completed job %s on %s", job, self)
-                self.end_job(job)
-
     def __str__(self):
 
         return "%s (%d jobs) (%d/%d cpu) (%d/%d ram)" % \
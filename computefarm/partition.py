@@ -0,0 +1,381 @@
+#!/usr/bin/python
+
+import logging
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from computefarm import RUNNING, IDLE, BatchExcept
+from farm import Farm, JobWouldViolate
+from job import BatchJob, JobTable
+from machine import Machine
+from ranking import depth_first, from_spec
+import trace as tr
+
+log = logging.getLogger('sim')
+
+
+class _Shard(Farm):
+    """ The machines of one partition of a PartitionedFarm, run in a worker
+        process. It starts the jobs it is sent on its machines as the farm's
+        ranking says, advances them and reports the ones that finished.
+    """
+
+    def __init__(self):
+        Farm.__init__(self)
+        self._jobs = JobTable()
+        self._ids = {}
+        self._done = []
+
+    def add_named(self, cpus, memory, names):
+        first = len(self._m)
+        self.add_machines(cpus, len(names), memory)
+        for machine, name in zip(self._m[first:], names):
+            machine.name = name
+        return self.summary()
+
+    def place(self, group, cpus, memory, ids, lengths):
+        """ Start as many of the jobs of @group, @cpus and @memory, with
+            master ids @ids and @lengths, as fit, in order. Returns the
+            (machine, slot) of each started job, the machines scanned and the
+            new summary.
+        """
+        table = self._jobs
+        scanned = self.neg_stats['machines_scanned']
+        first = table.append(len(ids), cpus=cpus, memory=memory, length=lengths,
+                             group=table.group_id(group), state=IDLE)
+        jobs = [BatchJob.view(table, first + n) for n in xrange(len(ids))]
+        placed = []
+        for machine, count in self.place_jobs(jobs):
+            for job in jobs[len(placed):len(placed) + count]:
+                table.pinned[job._handle] = job
+                self._ids[job] = ids[len(placed)]
+                placed.append((machine.number, job.slotid))
+        for n in xrange(len(placed), len(ids)):
+            table.free(first + n)
+        return placed, self.neg_stats['machines_scanned'] - scanned, self.summary()
+
+    def _finish_job(self, machine, job):
+        self._running.remove(job)
+        machine.end_job(job)
+        self._jobs.pinned.pop(job._handle)
+        self._jobs.free(job._handle)
+        self._done.append((self._ids.pop(job), job.runtime))
+
+    def advance(self, method, arg):
+        """ Call advance_time or advance_to, returning the (id, runtime) of
+            the jobs that finished and the new summary
+        """
+        getattr(self, method)(arg)
+        done, self._done = self._done, []
+        return done, self.summary()
+
+    def summary(self):
+        return self._slots.cells()
+
+    def describe(self):
+        return [x.long() for x in self]
+
+
+def _serve(conn):
+    # Runs in a worker process, see PartitionedFarm
+    shard = _Shard()
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        try:
+            conn.send((True, getattr(shard, msg[0])(*msg[1:])))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+class _Cells(object):
+    """ The free-slot summaries of all shards as rows of a table a Ranking
+        can score like a MachineTable, one row per cell of a SlotIndex
+    """
+
+    def __init__(self, summaries):
+        rows = [(t, f, m, n, s) for s, cells in enumerate(summaries) for t, f, m, n in cells]
+        total, free, memory, machines, shard = zip(*rows) if rows else ((),) * 5
+        self.size = len(rows)
+        self.totalcpus = np.array(total, np.int64)
+        self.cpus = np.array(free, np.int64)
+        self.memory = np.array(memory, np.float64)
+        self.totalmemory = self.memory
+        self.machines = np.array(machines, np.int64)
+        self.shard = np.array(shard, np.int64)
+
+
+class PartitionedFarm(Farm):
+    """ A farm whose machines are split between @shards worker processes.
+
+        Each worker holds its machines and the jobs running on them, advances
+        them and keeps its own SlotIndex, sending back a summary of it (the
+        number of machines and most free memory of each (total, free cpus)
+        cell) after every call. This process keeps the queue and the group
+        tree and negotiates as a Farm does, with the same quota and surplus
+        accounting, but places the jobs admitted from an autocluster in
+        batches: each batch is split between the workers in proportion to
+        the slots for them their summaries show, and the workers all start
+        theirs at the same time. Completed jobs are reported by the workers
+        as time is advanced and finished here.
+
+        Machine n is on worker n % shards. With one worker jobs land where
+        a Farm would put them; with more each worker ranks only its own
+        machines. Running jobs' runtime is only kept in the workers. The
+        ranking has to be one that ranking.from_spec() can rebuild, and a
+        partitioned farm can't be saved.
+    """
+
+    def __init__(self, shards=2, ranking=depth_first):
+        self._conns = []
+        self._procs = []
+        for _ in xrange(shards):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_serve, args=(child,))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+        self._summaries = [[] for _ in xrange(shards)]
+        self._names = []
+        self._memory = 0
+        # Running jobs by the id the workers know them by
+        self._placed = {}
+        self._next_id = 0
+        Farm.__init__(self, ranking)
+
+    def _call(self, shard, *msg):
+        self._conns[shard].send(msg)
+        return self._reply(shard)
+
+    def _reply(self, shard):
+        ok, value = self._conns[shard].recv()
+        if not ok:
+            raise BatchExcept("Farm partition %d failed:\n%s" % (shard, value))
+        return value
+
+    def _broadcast(self, *msg):
+        """ Have every worker handle @msg at the same time, returning the
+            replies in order
+        """
+        for conn in self._conns:
+            conn.send(msg)
+        return [self._reply(n) for n in xrange(len(self._conns))]
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+        for proc in self._procs:
+            proc.join()
+        self._conns = []
+        self._procs = []
+
+    def set_negotiatior_rank(self, fn):
+        policy = from_spec(fn)
+        spec = policy.spec()
+        if spec is None:
+            raise BatchExcept("A partitioned farm can't rank with %r" % policy)
+        self._jobsorter = policy
+        self._broadcast('set_negotiatior_rank', spec)
+
+    def count_machines(self):
+        return len(self._names)
+
+    def count_memory(self):
+        return self._memory
+
+    def add_machine(self, machine):
+        self._add(machine.totalcpus, machine.totalmemory, [machine.name])
+
+    def add_machines(self, cpus, count, memory=None):
+        memory = memory if memory is not None else 1000 * 2 * cpus
+        self._add(cpus, memory, ["node%04d" % Machine._ids.next() for _ in xrange(count)])
+
+    def _add(self, cpus, memory, names):
+        """ Deal machines named @names out to the workers, continuing from
+            where the last ones went
+        """
+        first = len(self._names)
+        self._names.extend(names)
+        shards = len(self._conns)
+        for n, conn in enumerate(self._conns):
+            conn.send(('add_named', cpus, memory,
+                       self._names[first + (n - first) % shards::shards]))
+        for n in xrange(shards):
+            self._summaries[n] = self._reply(n)
+        self._cpus += cpus * len(names)
+        self._memory += memory * len(names)
+
+    def __str__(self):
+        shards = len(self._conns)
+        machines = self._broadcast('describe')
+        return "\n".join(machines[n % shards][n // shards]
+                         for n in xrange(len(self._names)))
+
+    def get_state(self):
+        raise BatchExcept("A partitioned farm can't be saved")
+
+    def set_event_driven(self, enabled, quantum=0):
+        self.quantum = quantum if enabled else 0
+        self._broadcast('set_event_driven', enabled, quantum)
+
+    def next_completion(self):
+        # Completions are picked up in bulk whenever time is advanced
+        return None
+
+    def advance_time(self, step):
+        self._advance('advance_time', step)
+        self.time += step
+
+    def advance_to(self, time):
+        self._advance('advance_to', time)
+        self.time = time
+
+    def _advance(self, method, arg):
+        for n, (done, summary) in enumerate(self._broadcast('advance', method, arg)):
+            self._summaries[n] = summary
+            for jid, runtime in done:
+                job = self._placed.pop(jid)
+                job.runtime = runtime
+                job.finish()
+                log.info("Completed job %s on %s", job, job.current_node)
+
+    def _split(self, job, count):
+        """ Share @count jobs like @job between the workers in proportion to
+            the slots for them their summaries show, as a list of (worker,
+            number of jobs), the worker with the best ranked slot first. The
+            summaries only have the most free memory of each cell, so the
+            slots may be overcounted but never undercounted, any jobs beyond
+            them go to the best worker too.
+        """
+        cells = _Cells(self._summaries)
+        fits = (cells.cpus >= job.cpus) & (cells.memory >= job.memory)
+        if not fits.any():
+            return []
+        scores = self._jobsorter.score(cells, job)
+        best = cells.shard[np.where(fits, scores, -np.inf).argmax()]
+
+        slots = cells.cpus // job.cpus
+        if job.memory > 0:
+            slots = np.minimum(slots, cells.memory // job.memory)
+        slots = np.bincount(cells.shard, np.where(fits, slots * cells.machines, 0),
+                            len(self._conns)).astype(np.int64)
+        total = slots.sum()
+        if count >= total:
+            shares = slots
+            shares[best] += count - total
+        else:
+            # Largest remainder, so the shares add up to count
+            exact = slots * float(count) / total
+            shares = np.floor(exact).astype(np.int64)
+            shares[np.argsort(shares - exact)[:count - shares.sum()]] += 1
+        order = [best] + [n for n in xrange(len(shares)) if n != best]
+        return [(n, shares.item(n)) for n in order if shares[n]]
+
+    def _place(self, jobs):
+        """ Start as many of @jobs, all of one shape, as fit on the workers,
+            returning the (job, machine number) of those started. The jobs
+            are split between the workers by _split(), which all place
+            theirs at the same time, until all are started or nothing more
+            fits.
+        """
+        shards = len(self._conns)
+        placed = []
+        left = jobs
+        while left:
+            sent = []
+            first = 0
+            for shard, count in self._split(left[0], len(left)):
+                batch = left[first:first + count]
+                first += count
+                ids = range(self._next_id, self._next_id + count)
+                self._next_id += count
+                self._conns[shard].send(('place', batch[0].group, batch[0].cpus,
+                                         batch[0].memory, ids, [x.length for x in batch]))
+                sent.append((shard, batch, ids))
+
+            if not sent:
+                break
+            left = []
+            for shard, batch, ids in sent:
+                started, scanned, self._summaries[shard] = self._reply(shard)
+                self.neg_stats['machines_scanned'] += scanned
+                if started:
+                    self.queue.move_jobs(batch[:len(started)], RUNNING)
+                for job, jid, (local, slotid) in zip(batch, ids, started):
+                    number = local * shards + shard
+                    job.slotid = slotid
+                    job.current_node = self._names[number]
+                    job.node = number
+                    self._placed[jid] = job
+                    placed.append((job, number))
+                left.extend(batch[len(started):])
+            if len(left) == sum(len(batch) for _, batch, _ in sent):
+                break
+        return placed
+
+    def negotiate_cluster(self, group, demand, cpus, memory, rows):
+        """ Like Farm.negotiate_cluster, but the jobs the headroom of the
+            group lets start are sent to the workers to place in one batch
+        """
+        stats = self.neg_stats
+        trace = self.trace
+        name = group.name
+        queue = self.queue
+        weight = self.slotweight(queue._job(rows.item(0)))
+        no_fit = self._no_fit
+        i = 0
+
+        while i < len(rows):
+            headroom = self.headroom(group, weight)
+            if not headroom:
+                # See if the job is allowed to run, which may find surplus
+                stats['jobs_considered'] += 1
+                quota = group.norm_quota
+                try:
+                    self.allowed_run(queue._job(rows.item(i)), group, demand)
+                except JobWouldViolate:
+                    stats['rejected'] += 1
+                    i += 1
+                    if trace is None and group.norm_quota == quota:
+                        stats['jobs_considered'] += len(rows) - i
+                        stats['rejected'] += len(rows) - i
+                        return
+                    continue
+                batch = 1
+            else:
+                batch = min(headroom, len(rows) - i)
+                stats['jobs_considered'] += batch
+
+            if any(cpus >= c and memory >= m for c, m in no_fit):
+                placed = []
+            else:
+                placed = self._place(list(queue._jobs(rows[i:i + batch])))
+            for job, number in placed:
+                if trace is not None:
+                    trace.record(self.time, tr.MATCH, name, job.cpus, job.memory,
+                                 self._names[number])
+                stats['matches'] += 1
+                parent = group.parent
+                while parent:
+                    parent.surplus -= weight
+                    parent = parent.parent
+            i += len(placed)
+
+            if len(placed) < batch:
+                # No slot for this shape anywhere, the rest are admitted but
+                # can't fit
+                left = len(rows) - i
+                stats['no_slot'] += left
+                stats['jobs_considered'] += left - (batch - len(placed))
+                no_fit.append((cpus, memory))
+                if trace is not None:
+                    for _ in xrange(left):
+                        trace.record(self.time, tr.NO_SLOT, name, cpus, memory)
+                return
@@ -1,24 +1,214 @@
 #!/usr/bin/python
 
 import logging
+from collections import defaultdict
+
+import numpy as np
+
 from computefarm import IDLE, RUNNING
+from job import BatchJob, JobTable, FREE
 
 log = logging.getLogger('sim')
 
 
-class JobQueue(list):
-    """ A list of job-objects with some methods for querying the queue based on
-        properties of the jobs therein
+class JobQueue(object):
+    """ A collection of job-objects with some methods for querying the queue
+        based on properties of the jobs therein.
+
+        Jobs are stored as rows of a JobTable in submission order, so a queue
+        holds no Python object per job: BatchJob views are made as jobs are
+        looked at. Views of jobs that aren't idle are kept (pinned in the
+        table) so a running job is always the same object, views of idle
+        jobs are made afresh each time. The number of jobs per (group, state)
+        is kept up to date as jobs tell the queue about their state changes,
+        a job's group must not change while it is in the queue.
+
+        Functions registered with watch() are called as fn(job, old, new) on
+        every change of a job's state, where old is None for a newly added job
+        and new is None for a removed one.
     """
 
+    def __init__(self):
+        self.table = JobTable()
+        self._counts = defaultdict(int)
+        self._watchers = []
+
+    def watch(self, fn, batch=None):
+        """ Call fn(job, old, new) on every change of a job's state. If
+            @batch is given, jobs added or moved in bulk are instead reported
+            with one call batch(group, old, new, cpus), cpus being the array
+            of their cpus.
+        """
+        self._watchers.append((fn, batch))
+
+    def _notify(self, jobobj, old_state, new_state):
+        for fn, _ in self._watchers:
+            fn(jobobj, old_state, new_state)
+
+    def _job(self, row):
+        """ The BatchJob for @row of the table """
+        table = self.table
+        jobobj = table.pinned.get(row)
+        if jobobj is None:
+            jobobj = BatchJob.view(table, row, self)
+            if table.state.item(row) not in (IDLE, FREE):
+                table.pinned[row] = jobobj
+        return jobobj
+
+    def _jobs(self, rows):
+        """ Generate the jobs in @rows still in the queue, the table mustn't
+            be compacted meanwhile, as happens when jobs are added
+        """
+        table = self.table
+        epoch = table.epoch
+        job = self._job
+        for row in rows.tolist():
+            if table.epoch != epoch:
+                raise RuntimeError("Jobs added to the queue while iterating")
+            if table.state.item(row) != FREE:
+                yield job(row)
+
     def add_job(self, jobobj):
+        jobobj.move_to(self.table)
         jobobj.queue = self
+        self.table.pinned[jobobj._handle] = jobobj
         log.debug("Added job %s to queue", str(jobobj))
-        self.append(jobobj)
+        self._counts[jobobj.group, jobobj.state] += 1
+        self._notify(jobobj, None, jobobj.state)
+
+    def add_jobs(self, jobs):
+        """ Add a batch of job objects """
+        for jobobj in jobs:
+            self.add_job(jobobj)
+
+    def submit(self, group, count, cpus=1, memory=None, length=3600):
+        """ Add @count idle jobs of @group straight into the table, without
+            making a BatchJob for each. @cpus, @memory (by default 2000 per
+            cpu) and @length are single values or arrays of @count values.
+        """
+        if not count:
+            return
+        cpus = np.asarray(cpus)
+        memory = memory if memory is not None else cpus * 2000
+        first = self.table.append(count, cpus=cpus, memory=memory, length=length,
+                                  group=self.table.group_id(group), state=IDLE)
+        log.debug("Added %d %s jobs to queue", count, group)
+        self._added(first, count)
+
+    def _added(self, first, count):
+        """ Account for @count rows appended to the table from @first on """
+        table = self.table
+        rows = slice(first, first + count)
+        for fn, batch in self._watchers:
+            if batch is None:
+                for row in xrange(first, first + count):
+                    fn(self._job(row), None, table.state.item(row))
+
+        # Rows are split up by (group, state), usually all of them share one
+        key = table.group[rows].astype(np.int64) * 4 + table.state[rows]
+        for k in np.unique(key).tolist():
+            sel = key == k
+            group, state = table.group_names[k // 4], k % 4
+            self._counts[group, state] += int(sel.sum())
+            for fn, batch in self._watchers:
+                if batch is not None:
+                    batch(group, None, state, table.cpus[rows][sel])
+
+    def remove(self, jobobj):
+        """ Remove a job from the queue, like list.remove() raises ValueError
+            if it isn't there. The job is moved to a table of its own.
+        """
+        if jobobj.queue is not self:
+            raise ValueError("Job %s not in queue" % jobobj)
+        row = jobobj._handle
+        state = jobobj.state
+        self.table.pinned.pop(row, None)
+        jobobj.move_to(JobTable(1))
+        jobobj.queue = None
+        self.table.free(row)
+        self._counts[jobobj.group, state] -= 1
+        self._notify(jobobj, state, None)
+
+    def move(self, jobobj, old_state, new_state):
+        """ Called by a job when its state changes from @old_state to
+            @new_state to keep the counts right
+        """
+        if old_state == new_state:
+            return
+        if new_state != IDLE:
+            self.table.pinned[jobobj._handle] = jobobj
+        group = jobobj.group
+        self._counts[group, old_state] -= 1
+        self._counts[group, new_state] += 1
+        self._notify(jobobj, old_state, new_state)
+
+    def move_jobs(self, jobs, new_state):
+        """ Set the state of @jobs, all in this queue and of one group and
+            state, to @new_state, accounting for them together rather than
+            as each job's state changes
+        """
+        old_state = jobs[0].state
+        if old_state == new_state:
+            return
+        table = self.table
+        rows = [jobobj._handle for jobobj in jobs]
+        if new_state != IDLE:
+            for jobobj in jobs:
+                table.pinned[jobobj._handle] = jobobj
+        table.state[rows] = new_state
+        group = jobs[0].group
+        self._counts[group, old_state] -= len(jobs)
+        self._counts[group, new_state] += len(jobs)
+        for fn, batch in self._watchers:
+            if batch is None:
+                for jobobj in jobs:
+                    fn(jobobj, old_state, new_state)
+            else:
+                batch(group, old_state, new_state, table.cpus[rows])
+
+    def __iter__(self):
+        return self._jobs(self.table.rows())
+
+    def __len__(self):
+        return self.table.live
+
+    def __contains__(self, jobobj):
+        return jobobj.queue is self
 
     def __str__(self):
         return "\n".join([x.long() for x in self])
 
+    def rows(self, group, state):
+        """ Array of the table rows of the jobs of @group in @state """
+        table = self.table
+        try:
+            gid = table._group_ids[group]
+        except KeyError:
+            return np.zeros(0, np.int64)
+        n = table.size
+        return np.flatnonzero((table.group[:n] == gid) & (table.state[:n] == state))
+
+    def autoclusters(self, group, state=IDLE):
+        """ Split the jobs of @group in @state into autoclusters, jobs of the
+            same cpus and memory, as a list of (cpus, memory, rows) in the
+            order of the first job of each, rows in submission order
+        """
+        rows = self.rows(group, state)
+        if not len(rows):
+            return []
+        table = self.table
+        cpus = table.cpus[rows]
+        memory = table.memory[rows]
+        if (cpus == cpus[0]).all() and (memory == memory[0]).all():
+            return [(cpus.item(0), memory.item(0), rows)]
+
+        ucpus, icpus = np.unique(cpus, return_inverse=True)
+        umemory, imemory = np.unique(memory, return_inverse=True)
+        _, first, inverse = np.unique(icpus * len(umemory) + imemory,
+                                      return_index=True, return_inverse=True)
+        return [(cpus.item(i), memory.item(i), rows[inverse == k])
+                for k, i in sorted(enumerate(first.tolist()), key=lambda x: x[1])]
+
     def match_jobs(self, query):
         """ Return an iterator of all job objects where the properties match the
             values represented in @query.
@@ -26,6 +216,9 @@ class JobQueue(list):
             @query is a mapping of {'key': value}, like
                 {'group': 'short', 'state': IDLE}
             which would return all idle short jobs
+
+            The jobs matching are picked from the table when called, the
+            caller can start or finish jobs while iterating, but not add any.
         """
 
         def check_job(job, query):
@@ -34,10 +227,35 @@ class JobQueue(list):
                     return False
             return True
 
-        return (x for x in self if check_job(x, query))
+        if 'group' in query and 'state' in query:
+            candidates = self._jobs(self.rows(query['group'], query['state']))
+        else:
+            candidates = self._jobs(self.table.rows())
+
+        # Each job is re-checked in case it changed since the call
+        return (x for x in candidates if check_job(x, query))
+
+    def totals(self):
+        """ Recount {(group, state): (jobs, cpus)} from the table """
+        table = self.table
+        rows = table.rows()
+        key = table.group[rows].astype(np.int64) * 4 + table.state[rows]
+        keys, inverse = np.unique(key, return_inverse=True)
+        jobs = np.bincount(inverse)
+        cpus = np.bincount(inverse, table.cpus[rows])
+        return dict(((table.group_names[k // 4], k % 4), (n, int(c)))
+                    for k, n, c in zip(keys.tolist(), jobs.tolist(), cpus.tolist()))
+
+    def count_jobs(self, group=None, state=None):
+        """ Number of jobs in @group and/or @state (all if neither is given) """
+        if group is None and state is None:
+            return len(self)
+        return sum(n for (g, s), n in self._counts.iteritems()
+                   if (group is None or g == group) and
+                      (state is None or s == state))
 
     def get_group_idle(self, group):
-        return len([x for x in self if x.state == IDLE and x.group == group])
+        return self._counts.get((group, IDLE), 0)
 
     def get_group_running(self, group):
-        return len([x for x in self if x.state == RUNNING and x.group == group])
+        return self._counts.get((group, RUNNING), 0)
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+from collections import namedtuple
+
+import numpy as np
+
+# What a machine is scored for when a policy is called without a job
+_AnyJob = namedtuple('_AnyJob', 'cpus memory')
+_ANY_JOB = _AnyJob(1, 0)
+
+
+class Ranking(object):
+    """ A policy for choosing which of the machines a job fits on it is
+        started on.
+
+        score(table, job) is the one method a policy has to implement: it
+        returns a score for every machine of a MachineTable in one go and
+        the fitting machine with the highest score is picked, ties going to
+        the lowest numbered machine.
+
+        Policies the farm's SlotIndex can answer without scoring every
+        machine set indexed and override lookup(slots, job) to return the
+        best fitting machine, or None if none fits. For the others lookup()
+        returns None and is never consulted, the farm scores all machines.
+
+        key(machine, job) scores a single machine, calling a policy with a
+        machine does the same for a one cpu job, so policies still work as
+        the ranking functions used with max(). Policies whose key() would
+        have to score the whole table override it; to rank many machines
+        use keys(table, job), which scores the table once.
+    """
+
+    name = None
+    indexed = False
+
+    # Whether the machine picked for a job stays the best for the next job
+    # of the same shape for as long as it fits, so the farm can give it
+    # all the jobs that fit at once
+    fills = False
+
+    def score(self, table, job):
+        raise NotImplementedError("%s doesn't score machines" % self.__class__.__name__)
+
+    def lookup(self, slots, job):
+        return None
+
+    def key(self, machine, job=None):
+        return self.score(machine._table, job or _ANY_JOB)[machine.number]
+
+    def keys(self, table, job):
+        """ Key function for max() over machines of @table for @job """
+        scores = self.score(table, job)
+        return lambda machine: scores[machine.number]
+
+    def __call__(self, machine):
+        return self.key(machine)
+
+    def spec(self):
+        """ What from_spec() rebuilds this policy from, None if it can't """
+        return self.name
+
+    def __repr__(self):
+        return '<%s>' % (self.name or self.__class__.__name__)
+
+
+class DepthFirst(Ranking):
+    """ Fill up machines: the one with the fewest free cpus """
+    name = 'depth_first'
+    indexed = True
+    fills = True
+
+    def score(self, table, job):
+        return -table.cpus[:table.size]
+
+    def lookup(self, slots, job):
+        return slots.depth_first(job.cpus, job.memory)
+
+    def key(self, machine, job=None):
+        return -machine.cpus
+
+
+class BreadthFirst(Ranking):
+    """ Spread jobs out: the machine with the most free cpus """
+    name = 'breadth_first'
+    indexed = True
+
+    def score(self, table, job):
+        return table.cpus[:table.size]
+
+    def lookup(self, slots, job):
+        return slots.breadth_first(job.cpus, job.memory)
+
+    def key(self, machine, job=None):
+        return machine.cpus
+
+
+class LargestFirst(Ranking):
+    """ The machine with the most cpus in total """
+    name = 'largest_first'
+    indexed = True
+    fills = True
+
+    def score(self, table, job):
+        return table.totalcpus[:table.size]
+
+    def lookup(self, slots, job):
+        return slots.largest_first(job.cpus, job.memory)
+
+    def key(self, machine, job=None):
+        return machine.totalcpus
+
+
+class BestFitMemory(Ranking):
+    """ The machine left with the least free memory once the job is on it,
+        then the fewest free cpus, so big-memory slots stay free for the
+        jobs that need them
+    """
+    name = 'best_fit'
+    fills = True
+
+    def score(self, table, job):
+        n = table.size
+        scale = table.totalcpus[:n].max() + 1 if n else 1
+        left = (table.memory[:n] - job.memory) * scale + (table.cpus[:n] - job.cpus)
+        return -left
+
+    def key(self, machine, job=None):
+        job = job or _ANY_JOB
+        return (job.memory - machine.memory, job.cpus - machine.cpus)
+
+
+class MulticorePacking(Ranking):
+    """ Keep whole machines free for multicore jobs: jobs of fewer than
+        @cores cpus go on the fullest machine already running jobs and only
+        start on an idle machine, the smallest, if none has room. Jobs of
+        @cores or more go depth-first.
+    """
+    name = 'multicore'
+    indexed = True
+    fills = True
+
+    def __init__(self, cores=8):
+        self.cores = cores
+
+    def score(self, table, job):
+        n = table.size
+        free = table.cpus[:n]
+        if job.cpus >= self.cores or not n:
+            return -free
+        idle = free == table.totalcpus[:n]
+        return -free - idle * (table.totalcpus[:n].max() + 1)
+
+    def key(self, machine, job=None):
+        if (job or _ANY_JOB).cpus >= self.cores:
+            return -machine.cpus
+        return (machine.cpus != machine.totalcpus, -machine.cpus)
+
+    def lookup(self, slots, job):
+        if job.cpus >= self.cores:
+            return slots.depth_first(job.cpus, job.memory)
+        return slots.packing(job.cpus, job.memory)
+
+    def spec(self):
+        return self.name if self.cores == 8 else {'multicore': self.cores}
+
+
+class Weighted(Ranking):
+    """ Sum of the scores of other policies, given as [(policy, weight)] """
+    name = 'weighted'
+
+    def __init__(self, parts):
+        self.parts = [(from_spec(p), w) for p, w in parts]
+        for p, _ in self.parts:
+            if isinstance(p, Callback):
+                raise ValueError("Only policies scoring all machines can be combined")
+
+    def score(self, table, job):
+        total = np.zeros(table.size)
+        for policy, weight in self.parts:
+            total += weight * policy.score(table, job)
+        return total
+
+    def spec(self):
+        parts = [[p.spec(), w] for p, w in self.parts]
+        if any(p is None for p, _ in parts):
+            return None
+        return {'weighted': parts}
+
+
+class Callback(Ranking):
+    """ Any function of a machine, the higher the better, called for every
+        fitting machine for every job. The slow way, but anything goes.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def score(self, table, job):
+        return None
+
+    def key(self, machine, job=None):
+        return self.fn(machine)
+
+    def keys(self, table, job):
+        return self.fn
+
+    def spec(self):
+        return None
+
+    def __repr__(self):
+        return '<callback %r>' % self.fn
+
+
+depth_first = DepthFirst()
+breadth_first = BreadthFirst()
+largest_first = LargestFirst()
+best_fit = BestFitMemory()
+multicore = MulticorePacking()
+
+# Policies by name, as used in configs and saved farms
+rankings = dict((x.name, x) for x in (depth_first, breadth_first, largest_first,
+                                       best_fit, multicore))
+
+
+def from_spec(spec):
+    """ A policy from a Ranking, a name in rankings, {'multicore': cores},
+        {'weighted': [[spec, weight], ...]} or any other function of a
+        machine (as a Callback)
+    """
+    if isinstance(spec, Ranking):
+        return spec
+    if isinstance(spec, basestring):
+        try:
+            return rankings[spec]
+        except KeyError:
+            raise ValueError("Unknown ranking %s" % spec)
+    if isinstance(spec, dict):
+        (kind, arg), = spec.items()
+        if kind == 'weighted':
+            return Weighted(arg)
+        if kind == 'multicore':
+            return MulticorePacking(arg)
+        raise ValueError("Unknown ranking %s" % kind)
+    if callable(spec):
+        return Callback(spec)
+    raise ValueError("Not a ranking: %r" % (spec,))
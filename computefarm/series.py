@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import json
+import os
+
+import numpy as np
+
+_INDEX = 'index.json'
+
+
+def _chunk_files(path, n):
+    return (os.path.join(path, 'chunk%06d.npy' % n),
+            os.path.join(path, 'time%06d.npy' % n))
+
+
+class SeriesWriter(object):
+    """ Append-only on-disk history of per-group statistics for runs too long
+        to keep in a StatStore.
+
+        Samples are buffered @chunk at a time and written to directory @path
+        as .npy files, chunkNNNNNN.npy holding metrics x groups x samples and
+        timeNNNNNN.npy the sample times, with index.json listing the groups,
+        metrics and the length of each chunk. Memory use doesn't grow with
+        the length of the run. Writing to an existing series with the same
+        groups and metrics carries on after its last chunk.
+    """
+
+    def __init__(self, path, groups, metrics, chunk=4096):
+        self.path = path
+        self.groups = list(groups)
+        self.metrics = list(metrics)
+        self.chunks = []
+
+        if os.path.exists(os.path.join(path, _INDEX)):
+            with open(os.path.join(path, _INDEX)) as fp:
+                index = json.load(fp)
+            if index['groups'] != self.groups or index['metrics'] != self.metrics:
+                raise ValueError("%s holds a series of other groups or metrics" % path)
+            self.chunks = index['chunks']
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._data = np.zeros((len(self.metrics), len(self.groups), chunk), np.int64)
+        self._time = np.zeros(chunk)
+        self._n = 0
+
+    def append(self, time, values):
+        """ Add a sample like StatStore.append """
+        self._data[:, :, self._n] = values
+        self._time[self._n] = time
+        self._n += 1
+        if self._n == len(self._time):
+            self.flush()
+
+    def flush(self):
+        """ Write out the samples buffered so far as a chunk """
+        if not self._n:
+            return
+        data, times = _chunk_files(self.path, len(self.chunks))
+        np.save(data, self._data[:, :, :self._n])
+        np.save(times, self._time[:self._n])
+        self.chunks.append(self._n)
+        self._n = 0
+
+        # Replace the index in one go so a reader never sees half of it
+        tmp = os.path.join(self.path, _INDEX + '.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump({'groups': self.groups, 'metrics': self.metrics,
+                       'chunks': self.chunks}, fp)
+        os.rename(tmp, os.path.join(self.path, _INDEX))
+
+    def close(self):
+        self.flush()
+
+    def __len__(self):
+        return sum(self.chunks) + self._n
+
+
+class SeriesReader(object):
+    """ Read back a series written by SeriesWriter. Chunks are memory-mapped
+        as they are needed, so only the samples asked for are read in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _INDEX)) as fp:
+            index = json.load(fp)
+        self.groups = [str(x) for x in index['groups']]
+        self.metrics = [str(x) for x in index['metrics']]
+        self.chunks = index['chunks']
+        self._offsets = np.cumsum([0] + self.chunks)
+        self._group_row = dict((g, n) for n, g in enumerate(self.groups))
+        self._metric_row = dict((m, n) for n, m in enumerate(self.metrics))
+        self._mapped = {}
+
+    def _chunk(self, n):
+        try:
+            return self._mapped[n]
+        except KeyError:
+            data, times = _chunk_files(self.path, n)
+            chunk = self._mapped[n] = (np.load(data, mmap_mode='r'),
+                                       np.load(times, mmap_mode='r'))
+            return chunk
+
+    def _pieces(self, start, stop, step):
+        """ (chunk number, local sample indices) covering start:stop:step """
+        wanted = np.arange(len(self))[start:stop:step]
+        for n, (first, last) in enumerate(zip(self._offsets[:-1], self._offsets[1:])):
+            local = wanted[(wanted >= first) & (wanted < last)] - first
+            if len(local):
+                yield n, local
+
+    def times(self, start=None, stop=None, step=None):
+        """ Sample times, optionally of a slice start:stop:step of samples """
+        parts = [self._chunk(n)[1][local] for n, local in self._pieces(start, stop, step)]
+        return np.concatenate(parts) if parts else np.zeros(0)
+
+    def ordered(self, metric='usage', groups=None, start=None, stop=None, step=None):
+        """ The history of @metric as a groups x time array, like
+            StatStore.ordered, of the slice start:stop:step of samples
+        """
+        m = self._metric_row[metric]
+        rows = range(len(self.groups)) if groups is None else \
+            [self._group_row[g] for g in groups]
+        parts = [self._chunk(n)[0][m][rows][:, local]
+                 for n, local in self._pieces(start, stop, step)]
+        if not parts:
+            return np.zeros((len(rows), 0), np.int64)
+        return np.concatenate(parts, axis=1)
+
+    def __len__(self):
+        return int(self._offsets[-1])
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+from bisect import bisect_left, insort
+
+
+class SlotIndex(object):
+    """ Index of a farm's machines by their free resources.
+
+        Machines are numbered in the order they were added to the farm and
+        filed into cells keyed by (total cpus, free cpus), each cell mapping an
+        amount of free memory to a sorted list of machine numbers. The built-in
+        rankings can then find the best machine fitting a job by looking at a
+        handful of cells instead of every machine. Ties are broken by the
+        lowest machine number, the same machine max() would pick scanning the
+        farm.
+
+        Only cells holding machines are kept, along with the sorted free cpus
+        levels and totals they are found at and the sorted memory amounts of
+        each, so lookups never visit an empty cell and find the memory that
+        fits a job by bisection.
+
+        Machines call update() whenever their free resources change.
+
+        probes counts the candidate machines looked at by all lookups.
+    """
+
+    def __init__(self):
+        self._machines = []
+        self._cells = {}
+        # Sorted memory amounts of each cell
+        self._memories = {}
+        # Sorted totals with a cell at each free level, and the other way round
+        self._by_free = {}
+        self._by_total = {}
+        self._frees = []
+        self._totals = []
+        self.probes = 0
+
+    def add(self, machine):
+        """ Add @machine, which must be numbered one past the last one added """
+        assert machine.number == len(self._machines)
+        machine.slot_index = self
+        self._machines.append(machine)
+        if machine.totalcpus not in self._by_total:
+            insort(self._totals, machine.totalcpus)
+            self._by_total[machine.totalcpus] = []
+        self._insert(machine.number, machine.totalcpus, machine.cpus, machine.memory)
+
+    def _insert(self, number, total, cpus, memory):
+        key = total, cpus
+        cell = self._cells.get(key)
+        if cell is None:
+            cell = self._cells[key] = {}
+            self._memories[key] = []
+            totals = self._by_free.get(cpus)
+            if totals is None:
+                totals = self._by_free[cpus] = []
+                insort(self._frees, cpus)
+            insort(totals, total)
+            insort(self._by_total[total], cpus)
+        numbers = cell.get(memory)
+        if numbers is None:
+            numbers = cell[memory] = []
+            insort(self._memories[key], memory)
+        insort(numbers, number)
+
+    def _remove(self, number, total, cpus, memory):
+        key = total, cpus
+        cell = self._cells[key]
+        numbers = cell[memory]
+        del numbers[bisect_left(numbers, number)]
+        if numbers:
+            return
+        del cell[memory]
+        memories = self._memories[key]
+        del memories[bisect_left(memories, memory)]
+        if cell:
+            return
+        del self._cells[key]
+        del self._memories[key]
+        totals = self._by_free[cpus]
+        del totals[bisect_left(totals, total)]
+        if not totals:
+            del self._by_free[cpus]
+            del self._frees[bisect_left(self._frees, cpus)]
+        frees = self._by_total[total]
+        del frees[bisect_left(frees, cpus)]
+
+    def update(self, machine, old_cpus, old_memory):
+        """ Refile @machine after its free resources changed from @old_cpus
+            and @old_memory
+        """
+        if machine.cpus == old_cpus and machine.memory == old_memory:
+            return
+        self._remove(machine.number, machine.totalcpus, old_cpus, old_memory)
+        self._insert(machine.number, machine.totalcpus, machine.cpus, machine.memory)
+
+    def _first_fit(self, total, free, memory):
+        """ Lowest numbered machine of @total cpus with exactly @free cpus and
+            at least @memory free, or None
+        """
+        cell = self._cells.get((total, free))
+        if cell is None:
+            return None
+        memories = self._memories[total, free]
+        fits = memories[bisect_left(memories, memory):]
+        self.probes += len(fits)
+        if not fits:
+            return None
+        return min(cell[m][0] for m in fits)
+
+    def _first_of(self, cells, memory):
+        best = None
+        for total, free in cells:
+            n = self._first_fit(total, free, memory)
+            if n is not None and (best is None or n < best):
+                best = n
+        return best
+
+    def _levels(self, cpus, descending=False):
+        """ Free cpus levels holding machines, from @cpus up or down to it """
+        first = bisect_left(self._frees, cpus)
+        if descending:
+            return reversed(self._frees[first:])
+        return self._frees[first:]
+
+    def _best_at(self, free, memory, busy=False):
+        """ Lowest numbered machine with @free cpus and @memory, of those
+            running jobs only if @busy
+        """
+        totals = self._by_free[free]
+        if busy:
+            totals = totals[bisect_left(totals, free + 1):]
+        return self._first_of(((t, free) for t in totals), memory)
+
+    def _by_level(self, memory, levels):
+        for free in levels:
+            n = self._best_at(free, memory)
+            if n is not None:
+                return self._machines[n]
+        return None
+
+    def depth_first(self, cpus, memory):
+        """ Fitting machine with the fewest free cpus """
+        return self._by_level(memory, self._levels(cpus))
+
+    def breadth_first(self, cpus, memory):
+        """ Fitting machine with the most free cpus """
+        return self._by_level(memory, self._levels(cpus, True))
+
+    def packing(self, cpus, memory):
+        """ Fitting machine with the fewest free cpus of those running jobs
+            already, or if none fits the smallest idle one
+        """
+        for free in self._levels(cpus):
+            n = self._best_at(free, memory, busy=True)
+            if n is not None:
+                return self._machines[n]
+        for total in self._totals[bisect_left(self._totals, cpus):]:
+            n = self._first_fit(total, total, memory)
+            if n is not None:
+                return self._machines[n]
+        return None
+
+    def largest_first(self, cpus, memory):
+        """ Fitting machine with the most cpus in total """
+        for total in reversed(self._totals):
+            if total < cpus:
+                break
+            frees = self._by_total[total]
+            n = self._first_of(((total, f) for f in frees[bisect_left(frees, cpus):]),
+                               memory)
+            if n is not None:
+                return self._machines[n]
+        return None
+
+    def cells(self):
+        """ (total cpus, free cpus, most free memory, number of machines) of
+            each cell holding any machine, in order
+        """
+        cells = self._cells
+        return [(total, free, self._memories[total, free][-1],
+                 sum(len(numbers) for numbers in cells[total, free].itervalues()))
+                for total, free in sorted(cells)]
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+from collections import deque
+
+import numpy as np
+
+
+class StatStore(object):
+    """ Fixed-size history of per-group statistics in a circular buffer.
+
+        Every metric is one groups x time slab of a single array, written
+        column by column at a cursor that wraps around, so adding a sample
+        costs the same however long the history is and however many metrics
+        are tracked. Slots not written yet are zero and read as the oldest
+        samples, the same as a zero-filled array shifted left on each sample.
+    """
+
+    def __init__(self, groups, size, metrics=('usage',)):
+        self.groups = list(groups)
+        self.metrics = list(metrics)
+        self.size = size
+        self.data = np.zeros((len(self.metrics), len(self.groups), size), np.int64)
+        self.time = np.zeros(size)
+        self.cursor = 0
+        self.count = 0
+
+        self._group_row = dict((g, n) for n, g in enumerate(self.groups))
+        self._metric_row = dict((m, n) for n, m in enumerate(self.metrics))
+
+    def append(self, time, values):
+        """ Add a sample taken at @time, @values being an array-like of
+            metrics x groups in the order they were given
+        """
+        self.data[:, :, self.cursor] = values
+        self.time[self.cursor] = time
+        self.cursor = (self.cursor + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def rows(self, groups):
+        return [self._group_row[g] for g in groups]
+
+    def segments(self, metric='usage', groups=None):
+        """ The history of @metric as two views (older, newer) into the
+            buffer, each groups x time, without copying anything. With a
+            list of @groups only their rows are returned (as copies).
+        """
+        slab = self.data[self._metric_row[metric]]
+        if groups is not None:
+            slab = slab[self.rows(groups)]
+        return slab[:, self.cursor:], slab[:, :self.cursor]
+
+    def ordered(self, metric='usage', groups=None):
+        """ The history of @metric in time order as one groups x time array.
+            This is a copy, except for all groups when the cursor happens to
+            be back at the start of the buffer; use segments() to avoid it.
+        """
+        slab = self.data[self._metric_row[metric]]
+        rows = slice(None) if groups is None else self.rows(groups)
+        if self.cursor == 0:
+            return slab[rows]
+        cols = np.arange(self.cursor, self.cursor + self.size) % self.size
+        return slab[np.ix_(np.arange(len(self.groups))[rows], cols)]
+
+    def times(self):
+        """ Sample times in time order, oldest (or never written) first """
+        return np.concatenate((self.time[self.cursor:], self.time[:self.cursor]))
+
+    def latest(self, metric='usage'):
+        """ {group: value} of @metric in the last sample """
+        col = self.data[self._metric_row[metric], :, self.cursor - 1]
+        return dict(zip(self.groups, col.tolist()))
+
+    def get_state(self):
+        """ (meta, arrays) to rebuild this store with from_state() """
+        meta = {'groups': self.groups, 'metrics': self.metrics, 'size': self.size,
+                'cursor': self.cursor, 'count': self.count}
+        return meta, {'data': self.data, 'time': self.time}
+
+    @classmethod
+    def from_state(cls, meta, arrays):
+        self = cls([str(x) for x in meta['groups']], meta['size'],
+                   [str(x) for x in meta['metrics']])
+        self.data[...] = arrays['data']
+        self.time[:] = arrays['time']
+        self.cursor = meta['cursor']
+        self.count = meta['count']
+        return self
+
+    def __len__(self):
+        return self.count
+
+
+class SteadyState(object):
+    """ Tells when per-group values have settled, by the method of batch
+        means: samples are averaged over consecutive batches of @batch_size
+        and the values count as steady once, for every group, the means of
+        the last @batches batches are all within @tolerance of each other as
+        a fraction of @scale (e.g. the cpus of the farm). Only the running
+        sums of the current batch and the last batch means are kept.
+
+        Once steady, time is the time of the sample that made it so and
+        means() and shares() give the values over the last batches.
+    """
+
+    def __init__(self, groups, batch_size, batches=5, tolerance=0.01, scale=1):
+        self.groups = list(groups)
+        self.batch_size = batch_size
+        self.tolerance = tolerance
+        self.scale = scale
+        self.time = None
+        self._sum = np.zeros(len(self.groups))
+        self._n = 0
+        self._means = deque(maxlen=batches)
+
+    @property
+    def reached(self):
+        return self.time is not None
+
+    def add(self, time, values):
+        """ Add a sample of @values, one per group, taken at @time, returning
+            True once the values are steady
+        """
+        if self.time is not None:
+            return True
+        self._sum += values
+        self._n += 1
+        if self._n < self.batch_size:
+            return False
+
+        self._means.append(self._sum / self._n)
+        self._sum = np.zeros(len(self.groups))
+        self._n = 0
+        if len(self._means) < self._means.maxlen:
+            return False
+        means = np.array(self._means)
+        spread = (means.max(axis=0) - means.min(axis=0)) / float(self.scale)
+        if (spread <= self.tolerance).all():
+            self.time = time
+            return True
+        return False
+
+    def means(self):
+        """ {group: mean value over the last batches} """
+        if not self._means:
+            return {}
+        return dict(zip(self.groups, np.mean(self._means, axis=0).tolist()))
+
+    def shares(self):
+        """ {group: fraction of the summed means of all groups} """
+        means = self.means()
+        total = float(sum(means.values())) or 1.0
+        return dict((g, v / total) for g, v in means.iteritems())
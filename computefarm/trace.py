@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+import logging
+import struct
+from collections import deque
+
+log = logging.getLogger('sim')
+
+# Negotiation trace events, see _events below for the values each one carries
+(CYCLE, STATE, ORDER, SKIP, GROUP, MATCH, NO_SLOT, EXHAUSTED, OVER_QUOTA,
+ WOULD_EXCEED, SURPLUS, SURPLUS_ROOT, SURPLUS_STOP, SURPLUS_FOUND, NO_SURPLUS,
+ SURPLUS_SHORT, PARENT_AT_QUOTA, PARENT_WOULD_EXCEED) = range(18)
+
+# For each event: the binary format of its values (q=int, d=float, ?=bool,
+# n=group name) and the text it is rendered with. The group the event is
+# about is always the first %s of the text, if the event has one.
+_events = {
+    CYCLE:          ('q', 'Negotiate with %d jobs'),
+    STATE:          ('qqqqq', '%s: usage=%d quota=%d(%d) demand=%d surplus=%d'),
+    ORDER:          ('d', 'Group %s starvation order, usage/quota=%.3f'),
+    SKIP:           ('', 'No jobs for group %s, skip negotiating'),
+    GROUP:          ('qqq', 'Negotiate for %s: usage=%d quota=%d demand=%d'),
+    MATCH:          ('qdn', "Matched %s job (%d CPU %d Mb) to slot '%s'"),
+    NO_SLOT:        ('qd', 'No slots found matching %s job (%d CPU %d Mb)'),
+    EXHAUSTED:      ('', 'No more jobs submitted for group %s'),
+    OVER_QUOTA:     ('qq?', 'Group %s usage(%d) >= quota(%d), accept surplus %s'),
+    WOULD_EXCEED:   ('qqq', "Job of %s (%d CPU) would put usage(%d) over quota(%d)"),
+    SURPLUS:        ('qn', 'Group %s allocated %d surplus from %s'),
+    SURPLUS_ROOT:   ('', 'Group %s no longer any surplus available'),
+    SURPLUS_STOP:   ('', 'Group %s no longer accepts surplus'),
+    SURPLUS_FOUND:  ('qq', 'Surplus was found for %s (%d), quota now %d'),
+    NO_SURPLUS:     ('', 'No surplus available for %s, end.'),
+    SURPLUS_SHORT:  ('', 'Surplus for %s was not sufficient for job, not matching'),
+    PARENT_AT_QUOTA: ('qq', 'Group %s at quota %d (usage=%d)'),
+    PARENT_WOULD_EXCEED: ('qqq', 'Group %s: weight of %d would put it over quota %d (usage=%d)'),
+}
+
+_MAGIC = 'CFTRACE1'
+# Record header: event code, simulation time and group name id
+_header = struct.Struct('<Bdi')
+# Group names are written once, as a (255, id, length) header and the name
+_name_def = struct.Struct('<BiB')
+_NAME_DEF = 255
+
+
+def _value_struct(fmt):
+    return struct.Struct('<' + fmt.replace('n', 'i'))
+
+_value_structs = dict((k, _value_struct(v[0])) for k, v in _events.iteritems())
+
+
+class Trace(object):
+    """ Structured record of the decisions made during negotiation.
+
+        Each record is a tuple (time, event, group, values...) appended to a
+        bounded in-memory ring buffer, so only the most recent @size records
+        are kept. If @path is given records are also appended to that file
+        in a compact binary form that read_trace() can load back. With @echo
+        every record is rendered and logged at INFO level as it comes in.
+
+        Nothing is recorded unless a Trace is attached to the farm, and then
+        no text is formatted until render() is called.
+    """
+
+    def __init__(self, size=100000, path=None, echo=False):
+        self.records = deque(maxlen=size)
+        self.echo = echo
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'wb')
+            self._file.write(_MAGIC)
+            self._ids = {None: -1}
+
+    def record(self, time, event, group, *values):
+        rec = (time, event, group) + values
+        self.records.append(rec)
+        if self._file is not None:
+            self._write(rec)
+        if self.echo:
+            log.info(render_record(rec))
+
+    def _name_id(self, name):
+        try:
+            return self._ids[name]
+        except KeyError:
+            n = self._ids[name] = len(self._ids) - 1
+            self._file.write(_name_def.pack(_NAME_DEF, n, len(name)) + name)
+            return n
+
+    def _write(self, rec):
+        time, event, group = rec[:3]
+        fmt = _events[event][0]
+        values = [self._name_id(v) if f == 'n' else v for f, v in zip(fmt, rec[3:])]
+        self._file.write(_header.pack(event, time, self._name_id(group)) +
+                         _value_structs[event].pack(*values))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def render(self):
+        """ Human readable lines for all records in the ring buffer """
+        return [render_record(x) for x in self.records]
+
+
+def render_record(rec):
+    time, event, group = rec[:3]
+    text = _events[event][1]
+    args = rec[3:] if group is None else (group,) + rec[3:]
+    return 't=%d %s' % (time, text % args)
+
+
+def read_trace(path):
+    """ Generate the records stored in a binary trace file written by Trace """
+
+    with open(path, 'rb') as fp:
+        if fp.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not a trace file" % path)
+
+        names = {-1: None}
+        while True:
+            code = fp.read(1)
+            if not code:
+                break
+            if ord(code) == _NAME_DEF:
+                _, n, length = _name_def.unpack(code + fp.read(_name_def.size - 1))
+                names[n] = fp.read(length)
+                continue
+
+            event, time, group = _header.unpack(code + fp.read(_header.size - 1))
+            vs = _value_structs[event]
+            values = vs.unpack(fp.read(vs.size))
+            values = tuple(names[v] if f == 'n' else v
+                           for f, v in zip(_events[event][0], values))
+            yield (time, event, names[group]) + values
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+import csv
+import gzip
+import json
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+log = logging.getLogger('sim')
+
+# Fields of a job record, the keys of the @columns mappings below map them to
+# the names used in a particular log (e.g. {'submit': 'QDate'})
+FIELDS = ('submit', 'group', 'cpus', 'memory', 'runtime')
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _record(row, columns):
+    """ (submit, group, cpus, memory, runtime) from a mapping @row """
+    columns = columns or {}
+    get = lambda f: row.get(columns.get(f, f))
+    memory = get('memory')
+    return (float(get('submit')), str(get('group')), int(float(get('cpus') or 1)),
+            float(memory) if memory not in (None, '') else None,
+            float(get('runtime')))
+
+
+def read_csv(path, columns=None):
+    """ Generate job records from a CSV file with a header line, read a line
+        at a time so the file can be any size. Files ending in .gz are
+        decompressed on the fly.
+    """
+    with _open(path) as fp:
+        for row in csv.DictReader(fp):
+            yield _record(row, columns)
+
+
+def read_jsonl(path, columns=None):
+    """ Generate job records from a file of one JSON object per line """
+    with _open(path) as fp:
+        for line in fp:
+            if line.strip():
+                yield _record(json.loads(line), columns)
+
+
+def read_log(path, columns=None):
+    """ Job records from a .csv or .jsonl (optionally .gz) file at @path """
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.jsonl') or name.endswith('.json'):
+        return read_jsonl(path, columns)
+    return read_csv(path, columns)
+
+
+class Replay(object):
+    """ Submit jobs recorded in a real batch system's accounting log as the
+        simulation time reaches their submit times.
+
+        @records is an iterable of (submit, group, cpus, memory, runtime)
+        tuples in submit time order, like read_log() generates. They are
+        consumed lazily, only the next job not yet due is held in memory,
+        and go into the queue's job table without making BatchJob objects.
+        Submit times are shifted so the first job is submitted at @start.
+
+        Jobs of groups not in @groups, if given, are dropped and counted in
+        skipped.
+    """
+
+    def __init__(self, records, start=0, groups=None):
+        self._records = iter(records)
+        self.groups = groups
+        self.submitted = 0
+        self.skipped = defaultdict(int)
+        self._next = next(self._records, None)
+        self.offset = start - self._next[0] if self._next is not None else 0
+        self._last = None
+
+    def next_time(self):
+        """ Simulation time the next job is submitted at, None when done """
+        if self._next is None:
+            return None
+        return self._next[0] + self.offset
+
+    def submit_until(self, queue, time):
+        """ Add all jobs due by @time to @queue, returning how many """
+        count = 0
+        batch = []
+        while self._next is not None and self._next[0] + self.offset <= time:
+            submit, group, cpus, memory, runtime = self._next
+            if self._last is not None and submit < self._last:
+                raise ValueError("Job log not in submit time order at %s" % submit)
+            self._last = submit
+
+            if self.groups is not None and group not in self.groups:
+                self.skipped[group] += 1
+            else:
+                # Jobs are added in batches of one group
+                if batch and batch[0][0] != group:
+                    self._submit(queue, batch)
+                    batch = []
+                cpus = cpus if cpus else 1
+                batch.append((group, cpus, memory if memory is not None else cpus * 2000,
+                              runtime))
+                count += 1
+            self._next = next(self._records, None)
+
+        self._submit(queue, batch)
+        if count:
+            log.info("Replayed %d jobs up to t=%d", count, time)
+        self.submitted += count
+        return count
+
+    @staticmethod
+    def _submit(queue, batch):
+        if batch:
+            _, cpus, memory, length = zip(*batch)
+            queue.submit(batch[0][0], len(batch), cpus=np.array(cpus),
+                         memory=np.array(memory), length=np.array(length))
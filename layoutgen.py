@@ -58,23 +58,22 @@ class QueueManage(object):
         group_name = extract_group(self.sender())
         self.controls[group_name]['valueLabel'].setText(str(demand))
         group = self.sim.farm.groups.get_by_name(group_name)
-        group.num = demand
+        self.runner.call(setattr, group, 'num', demand)
 
     def quota_changed(self, val):
         group = self.sim.farm.groups.get_by_name(extract_group(self.sender()))
-        group.quota = int(val)
+        self.runner.call(setattr, group, 'quota', int(val))
 
     def set_surplus(self, state):
         group = self.sim.farm.groups.get_by_name(extract_group(self.sender()))
-        group.accept_surplus = bool(state)
+        self.runner.call(setattr, group, 'accept_surplus', bool(state))
 
 
 class MainStats(object):
 
     def _format_grpstr(self, grp):
-        idle = self.sim.farm.queue.get_group_idle(grp.name)
         return '%s (q=%d,s=%s): (run/idle) %d/%d' % \
-               (grp.name, grp.norm_quota, grp.accept_surplus, grp.usage, idle)
+               (grp.name, grp.norm_quota, grp.accept_surplus, grp.usage, grp.idle)
 
     def make_status_layout(self):
         self._stat_labels = {}
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+""" Run the farm simulation without the GUI, as fast as it goes, for a given
+    amount of simulated time and write out the group usage statistics.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from simulation import Simulation
+
+log = logging.getLogger('sim')
+
+_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_duration(text):
+    """ Seconds in @text like '3600', '90m', '12h', '7d' or '2w' """
+    text = str(text).strip()
+    if text and text[-1] in _units:
+        return float(text[:-1]) * _units[text[-1]]
+    return float(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('config', nargs='?',
+                        help='JSON config file (see atlas.json), without one '
+                             'the built-in ATLAS setup is used')
+    parser.add_argument('-d', '--duration', type=parse_duration,
+                        help='simulated time to run, e.g. 12h or 7d '
+                             '(default: "duration" from the config, or 1d)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='CSV file for the usage statistics (default: stdout)')
+    parser.add_argument('--series', metavar='DIR',
+                        help='also record every statistics sample of the run '
+                             'on disk in DIR, see computefarm.SeriesReader')
+    parser.add_argument('--ticks', action='store_true',
+                        help='advance in fixed steps instead of event to event')
+    parser.add_argument('--report', action='store_true',
+                        help='print time spent per phase and negotiation '
+                             'counters on stderr at the end')
+    parser.add_argument('--profile', metavar='PHASE', action='append', default=[],
+                        help='profile a phase (add_jobs, negotiate_jobs, '
+                             'advance_time, _update_stat), implies --report')
+    parser.add_argument('--restore', metavar='FILE',
+                        help='start from a checkpoint written with --save '
+                             'instead of an empty farm built from the config')
+    parser.add_argument('--replay', metavar='LOG',
+                        help='also submit the jobs of a .csv or .jsonl job log '
+                             '(columns submit, group, cpus, memory, runtime) '
+                             'at their recorded submit times')
+    parser.add_argument('--steady', metavar='TOL', type=float,
+                        help='stop once group usage is steady: its mean over '
+                             'each fifth of the --steady-window varies by no '
+                             'more than TOL (a fraction of the farm\'s cpus)')
+    parser.add_argument('--steady-window', metavar='TIME', type=parse_duration,
+                        default=6 * 3600,
+                        help='span of time steady state is judged over '
+                             '(default 6h)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write a checkpoint of the simulation at the end')
+    parser.add_argument('--shards', metavar='N', type=int,
+                        help='split the farm\'s machines between N worker '
+                             'processes (overrides "shards" in the config). '
+                             'With N > 1 each batch of jobs is split between '
+                             'the workers, so results are only approximate, '
+                             'most of all under spreading rankings such as '
+                             'breadth_first')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.INFO if args.verbose else logging.WARNING,
+                        format="(%(levelname)5s) %(message)s")
+
+    config = {}
+    if args.config:
+        with open(args.config) as fp:
+            config = json.load(fp)
+    if args.shards:
+        config['shards'] = args.shards
+
+    duration = args.duration
+    if duration is None:
+        duration = parse_duration(config.get('duration', '1d'))
+
+    if args.restore:
+        sim = Simulation.load(args.restore)
+    else:
+        sim = Simulation.from_config(config)
+    if args.replay:
+        sim.replay(args.replay)
+    for phase in args.profile:
+        sim.profile_phase(phase)
+
+    if args.series:
+        sim.record_series(args.series)
+    if args.steady is not None:
+        sim.detect_steady_state(args.steady_window, args.steady)
+
+    start = time.time()
+    if args.ticks:
+        sim.set_event_driven(False)
+        sim.step(int(round(duration / sim.sec_per_step)))
+    else:
+        if sim.events is None:
+            sim.set_event_driven(True)
+        sim.run_until(sim.farm.time + duration)
+    wall = time.time() - start
+    sim.close_series()
+    sim.farm.close()
+
+    sys.stderr.write("Simulated %ds in %.2fs (%.0f simulated s/s)\n" %
+                     (sim.farm.time, wall, sim.farm.time / max(wall, 1e-9)))
+    if sim.steady is not None:
+        if sim.steady.reached:
+            sys.stderr.write("Steady state at t=%d, usage shares: %s\n" % (
+                sim.steady.time, ", ".join("%s %.1f%%" % (g, 100 * v) for g, v in
+                                           sorted(sim.steady.shares().items()))))
+        else:
+            sys.stderr.write("No steady state reached\n")
+    if args.report or args.profile:
+        sim.report_timing(sys.stderr)
+
+    if args.save:
+        sim.save(args.save)
+
+    if args.output == '-':
+        sim.write_stats(sys.stdout)
+    else:
+        with open(args.output, 'w') as fp:
+            sim.write_stats(fp)
+
+
+if __name__ == '__main__':
+    main()
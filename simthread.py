@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+""" Run a Simulation in a thread of its own for the GUI, which only ever
+    looks at the latest Snapshot the thread has published.
+"""
+
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+log = logging.getLogger('sim')
+
+# What the status labels show of a group
+GroupStat = namedtuple('GroupStat', 'name norm_quota accept_surplus usage idle')
+
+
+class Snapshot(namedtuple('Snapshot', 'time next_negotiate next_submit groups x y')):
+    """ The state of a simulation for display: the time and when the next
+        negotiation and submission are due, a GroupStat per active group by
+        name in groups, and the usage history of the groups in the
+        simulation's display order as arrays x and y, which are read-only
+        copies the simulation won't touch again
+    """
+    __slots__ = ()
+
+    @classmethod
+    def take(cls, sim):
+        x, y = sim.make_plotdata()
+        x.flags.writeable = False
+        y.flags.writeable = False
+        groups = dict((g.name, GroupStat(g.name, g.norm_quota, g.accept_surplus,
+                                         g.usage, g.idle))
+                      for g in sim.farm.groups.active_groups())
+        return cls(sim.farm.time, sim.next_negotiate, sim.next_submit, groups, x, y)
+
+
+class SimThread(threading.Thread):
+    """ Steps @sim by step_size ticks at a time, sleeping delay seconds in
+        between, while running and once for each step_once().
+
+        A Snapshot is published after a step at most every @publish_interval
+        seconds, and always when stopping, each replacing the last one; the
+        ones nobody took in time are simply dropped.
+
+        Nothing else may touch the simulation while the thread runs: changes
+        are passed as functions to call(), which runs them between steps.
+    """
+
+    def __init__(self, sim, step_size=10, delay=0, publish_interval=1.0 / 60):
+        super(SimThread, self).__init__(name='simulation')
+        self.daemon = True
+        self.sim = sim
+        self.step_size = step_size
+        self.delay = delay
+        self.publish_interval = publish_interval
+
+        self._cond = threading.Condition()
+        self._calls = deque()
+        self._running = False
+        self._steps = 0
+        self._quit = False
+        self._latest = Snapshot.take(sim)
+        self._published = 0
+
+    def latest(self):
+        """ The last snapshot published, or None if it was already taken """
+        with self._cond:
+            snap, self._latest = self._latest, None
+        return snap
+
+    def _publish(self):
+        snap = Snapshot.take(self.sim)
+        with self._cond:
+            self._latest = snap
+        self._published = time.time()
+
+    def call(self, fn, *args):
+        """ Have the thread call fn(*args) on its next turn """
+        with self._cond:
+            self._calls.append((fn, args))
+            self._cond.notify()
+
+    def set_step_size(self, ticks):
+        self.step_size = ticks
+
+    def resume(self):
+        with self._cond:
+            self._running = True
+            self._cond.notify()
+
+    def pause(self):
+        with self._cond:
+            self._running = False
+
+    def step_once(self):
+        with self._cond:
+            self._steps += 1
+            self._cond.notify()
+
+    def stop(self):
+        """ End the thread after the step under way, waiting for it """
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not (self._quit or self._calls or self._running or self._steps):
+                    self._cond.wait()
+                if self._quit:
+                    break
+                calls = list(self._calls)
+                self._calls.clear()
+                stepping = self._running or self._steps > 0
+                self._steps = 0 if self._running else max(self._steps - 1, 0)
+
+            for fn, args in calls:
+                fn(*args)
+
+            if not stepping:
+                # Show the effect of the changes while paused
+                self._publish()
+                continue
+
+            self.sim.step(self.step_size)
+            if (not self._running or
+                    time.time() - self._published >= self.publish_interval):
+                self._publish()
+            if self.delay:
+                with self._cond:
+                    if self._running and not (self._quit or self._calls):
+                        self._cond.wait(self.delay)
+
+        self._publish()
@@ -1,9 +1,17 @@
 #!/usr/bin/python
 
 import computefarm as cf
-from computefarm.farm import depth_first, breadth_first
-import random
+from computefarm.ranking import depth_first, breadth_first
+from computefarm.events import SUBMIT, NEGOTIATE, STAT, first_tick_after, quantize
+import cProfile
+import io
+import json
 import logging
+import multiprocessing
+import pstats
+import time
+import traceback
+import zlib
 
 import numpy as np
 
@@ -19,6 +27,22 @@ default_queue_properties = {
     'mp8':      { 'num': 0,  'avg': 6 * HOUR, 'std': 4 * HOUR, 'cpu': 8, 'mem': 6000}
 }
 
+# Distribution of farm nodes, e.g. 331/90 is ratio of 24/32 core machines
+default_farm_dist = (
+    (24, 331),
+    (32, 90),
+    (8, 238),
+)
+
+# Per-group statistics sampled every stat interval, see StatStore
+STAT_METRICS = ('usage', 'running', 'idle', 'demand', 'norm_quota')
+
+# Phases of a simulation step whose wall time is accounted for separately
+PHASES = ('add_jobs', 'negotiate_jobs', 'advance_time', '_update_stat')
+
+# Version of the checkpoint format written by Simulation.save
+CHECKPOINT_VERSION = 1
+
 
 def sort_like(array, like):
     # All items in @like are picked in order if they exist in the array
@@ -32,28 +56,42 @@ def sort_like(array, like):
 log = logging.getLogger('sim')
 
 
+def _run_forked(conn, sim, fn, scenario):
+    # Runs in the child process, see Simulation.fork_map
+    try:
+        conn.send((True, fn(sim, scenario)))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
 class Simulation(object):
 
-    def __init__(self, nodes, negotiate_interval=150, stat_freq=10, submit_interval=200):
+    def __init__(self, nodes, negotiate_interval=150, stat_freq=10, submit_interval=200,
+                 seed=None, farm_dist=default_farm_dist, groups=None, shards=None):
         """ Initialize the farm simulation, attach groups and queues to it and
             provide method of submitting jobs of a predetermined size into the
             queues.
-        """
 
-        self.farm = cf.Farm()
+            Each group draws its job lengths from a random stream of its own,
+            with a @seed the streams and so the whole run are reproducible.
 
-        # Distribution of farm nodes, e.g. 331/90 is ratio of 24/32 core machines
-        dist = (
-            (24, 331),
-            (32, 90),
-            (8, 238),
-        )
-        self.farm.generate_from_dist(dist, size=nodes)
+            @farm_dist and @groups are passed on to Farm.generate_from_dist
+            and setup_groups respectively. With @shards the machines are
+            split between that many worker processes, see
+            computefarm.PartitionedFarm, and farm.close() ends them.
+        """
 
-        root = self.setup_groups(cf.Group('<root>'))
+        self.farm = cf.PartitionedFarm(shards) if shards else cf.Farm()
+        self.farm.generate_from_dist(farm_dist, size=nodes)
+
+        root = self.setup_groups(cf.Group('<root>'), groups)
         self.farm.attach_groups(root)
         self._init_stat(stat_freq * 100)
 
+        # On-disk history of the statistics, see record_series()
+        self.series = None
+
         #Default ranking
         self.farm.set_negotiatior_rank(depth_first)
 
@@ -71,6 +109,22 @@ class Simulation(object):
         # How many seconds to simulate each step
         self.sec_per_step = 5
 
+        # Pending submit/negotiate/stat events when running event-driven
+        self.events = None
+
+        # A computefarm.Replay of recorded jobs being submitted, see replay()
+        self.workload = None
+
+        # A computefarm.SteadyState watching group usage, see
+        # detect_steady_state(), and whether it ended the last run
+        self.steady = None
+        self._coarsen = None
+        self.stopped = False
+
+        self.reset_timing()
+
+        self.set_seed(seed)
+
     # these two _set* knobs are used in callbacks by the GUI
     def _set_neg_df(self):
         self.farm.set_negotiatior_rank(depth_first)
@@ -78,26 +132,308 @@ class Simulation(object):
     def _set_neg_bf(self):
         self.farm.set_negotiatior_rank(breadth_first)
 
+    @classmethod
+    def from_config(cls, config):
+        """ Build a simulation from a config mapping, usually loaded from a
+            JSON file like atlas.json. All keys are optional:
+
+            nodes       farm size, or null to take the counts in farm as is
+            farm        [[cpus, weight], ...] distribution of machines
+            groups      group tree, see setup_groups
+            intervals   {"negotiate": s, "submit": s, "stat": s, "step": s}
+            ranking     one of the names in computefarm.ranking.rankings, or
+                        {"multicore": cores} or
+                        {"weighted": [[ranking, weight], ...]}
+            seed        seed for the job length random streams
+            shards      worker processes to split the farm between
+        """
+        intervals = config.get('intervals', {})
+        sim = cls(config.get('nodes', 400),
+                  negotiate_interval=intervals.get('negotiate', 150),
+                  stat_freq=intervals.get('stat', 10),
+                  submit_interval=intervals.get('submit', 200),
+                  seed=config.get('seed'),
+                  farm_dist=config.get('farm', default_farm_dist),
+                  groups=config.get('groups'),
+                  shards=config.get('shards'))
+        if 'step' in intervals:
+            sim.sec_per_step = intervals['step']
+        sim.farm.set_negotiatior_rank(config.get('ranking', 'depth_first'))
+        return sim
+
+    def save(self, fp, compress=False):
+        """ Checkpoint the whole simulation: farm, queue, group tree, random
+            streams, statistics and pending events, to @fp (a path or a file
+            object) in NumPy's .npz format. Machines, jobs and statistics are
+            stored as arrays, the rest as a JSON document in '_meta'.
+
+            Timing, profiles, a job log being replayed, the series being
+            recorded, steady state detection and any trace attached to the
+            farm are not saved.
+        """
+        meta, arrays = self.farm.get_state()
+        meta = {'version': CHECKPOINT_VERSION, 'farm': meta}
+
+        stat_meta, stat_arrays = self.stats.get_state()
+        meta['stats'] = stat_meta
+        for k, v in stat_arrays.iteritems():
+            arrays['stat_' + k] = v
+
+        # A RandomState is a key array plus a few scalars
+        meta['rngs'] = {}
+        for name, rng in self._rngs.iteritems():
+            _, keys, pos, has_gauss, gauss = rng.get_state()
+            meta['rngs'][name] = [pos, has_gauss, gauss]
+            arrays['rng_' + name] = keys
+
+        meta['sim'] = {
+            'seed': self.seed,
+            'intervals': [self.int_stat, self.int_negotiate, self.int_submit],
+            'next': [self.next_stat, self.next_negotiate, self.next_submit],
+            'sec_per_step': self.sec_per_step,
+            'events': (sorted((t, kind) for t, kind, _ in self.events)
+                       if self.events is not None else None),
+        }
+
+        arrays['_meta'] = np.array(json.dumps(meta))
+        (np.savez_compressed if compress else np.savez)(fp, **arrays)
+
+    @classmethod
+    def load(cls, fp):
+        """ A simulation restored from a checkpoint written by save(), it
+            carries on exactly as the one saved would have
+        """
+        with np.load(fp) as data:
+            arrays = dict((k, data[k]) for k in data.files)
+        meta = json.loads(arrays.pop('_meta').item())
+        if meta['version'] != CHECKPOINT_VERSION:
+            raise cf.BatchExcept("Unsupported checkpoint version %s" % meta['version'])
+
+        self = cls.__new__(cls)
+        self.farm = cf.Farm.from_state(meta['farm'], arrays)
+        self.queue = self.farm.queue
+
+        self.stats = cf.StatStore.from_state(meta['stats'], {
+            'data': arrays['stat_data'], 'time': arrays['stat_time']})
+        self._stat_groups = [self.farm.groups.get_by_name(x) for x in self.stats.groups]
+        self._stat_size = self.stats.size
+        self.series = None
+
+        sim = meta['sim']
+        self.int_stat, self.int_negotiate, self.int_submit = sim['intervals']
+        self.next_stat, self.next_negotiate, self.next_submit = sim['next']
+        self.sec_per_step = sim['sec_per_step']
+        self.events = None
+        self.workload = None
+        self.steady = None
+        self._coarsen = None
+        self.stopped = False
+        if sim['events'] is not None:
+            self.events = cf.EventQueue()
+            for t, kind in sim['events']:
+                self.events.push(t, kind)
+
+        self.reset_timing()
+        self.set_seed(sim['seed'])
+        for name, (pos, has_gauss, gauss) in meta['rngs'].iteritems():
+            name = str(name)
+            rng = self._rngs[name] = np.random.RandomState()
+            rng.set_state(('MT19937', arrays['rng_' + name], pos, has_gauss, gauss))
+        return self
+
+    def fork(self):
+        """ An independent copy of this simulation in its current state """
+        buf = io.BytesIO()
+        self.save(buf)
+        buf.seek(0)
+        return self.load(buf)
+
+    def fork_map(self, fn, scenarios, processes=None):
+        """ Call fn(sim, scenario) for each of @scenarios in a child process
+            forked from this one, so each starts from the current state of the
+            simulation without copying it up front: memory is shared with
+            this process copy-on-write. At most @processes (default: number
+            of CPUs) run at once. Returns the list of results, which have to
+            be picklable; an exception in a child is raised as BatchExcept.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        pending = list(enumerate(scenarios))
+        results = [None] * len(pending)
+        running = []
+        try:
+            while pending or running:
+                while pending and len(running) < processes:
+                    n, scenario = pending.pop(0)
+                    conn, child = multiprocessing.Pipe(False)
+                    proc = multiprocessing.Process(target=_run_forked,
+                                                   args=(child, self, fn, scenario))
+                    proc.start()
+                    child.close()
+                    running.append((n, proc, conn))
+
+                n, proc, conn = running.pop(0)
+                ok, value = conn.recv()
+                proc.join()
+                if not ok:
+                    raise cf.BatchExcept("Scenario %d failed:\n%s" % (n, value))
+                results[n] = value
+        finally:
+            for _, proc, _ in running:
+                proc.terminate()
+                proc.join()
+        return results
+
     def _init_stat(self, hist_size):
-        """ Statistics are kept in a constant-size numpy array that is updated
-            periodically
+        """ Statistics are kept in a constant-size circular buffer that is
+            updated periodically
         """
 
-        self._stat = {}
+        self._stat_groups = list(self.farm.groups.active_groups())
         self._stat_size = hist_size
-        for x in self.farm.groups.active_groups():
-            self._stat[x.name] = np.zeros((hist_size), int)
+        self.stats = cf.StatStore([x.name for x in self._stat_groups], hist_size,
+                                  STAT_METRICS)
 
     def _update_stat(self):
         self.farm.update_usage()
-        for g in self.farm.groups.active_groups():
-            # Left-shift entire array back by one, so element n -> element n - 1
-            self._stat[g.name] = np.roll(self._stat[g.name], -1)
-            # New last element is current update
-            self._stat[g.name][-1] = g.usage
+        values = [[getattr(g, m) or 0 for g in self._stat_groups] for m in STAT_METRICS]
+        self.stats.append(self.farm.time, values)
+        if self.series is not None:
+            self.series.append(self.farm.time, values)
+        if self.steady is not None and not self.steady.reached:
+            if self.steady.add(self.farm.time, values[0]):
+                self._steady_reached()
+
+    def detect_steady_state(self, window=6 * HOUR, tolerance=0.01, batches=5,
+                            coarsen=None):
+        """ Watch the usage of the groups for a steady state: when over the
+            last @window seconds, split in @batches batches, the mean usage of
+            each group changes by no more than @tolerance of the farm's cpus
+            from batch to batch. See computefarm.SteadyState.
+
+            Once steady the run under way stops, step() and run_until()
+            returning early, or with @coarsen statistics are gathered that
+            many times less often from then on and the run goes on. Either
+            way self.steady has the time steady state was reached and the
+            equilibrium means() and shares() of the groups.
+        """
+        batch_size = max(int(window / batches / self.stat_interval()), 1)
+        self.steady = cf.SteadyState(self.stats.groups, batch_size, batches,
+                                     tolerance, self.farm.count_cpus())
+        self._coarsen = coarsen
+
+    def _steady_reached(self):
+        log.info("Steady state reached at t=%d", self.farm.time)
+        if self._coarsen:
+            # Such that stat_interval() grows @coarsen times
+            self.int_stat = self.stat_interval() * self._coarsen - self.sec_per_step
+        else:
+            self.stopped = True
+
+    def stat_interval(self):
+        """ Seconds between statistics samples, which are taken at the first
+            step after int_stat seconds have passed, ticking or event-driven
+        """
+        return first_tick_after(self.int_stat, self.sec_per_step)
 
-    def setup_groups(self, root):
-        """ Reflects current ATLAS group structure:
+    def record_series(self, path, chunk=4096):
+        """ Besides the fixed window in self.stats, write every statistics
+            sample to a computefarm.SeriesWriter in directory @path for as
+            long as the simulation runs. Call close_series() at the end.
+        """
+        self.close_series()
+        self.series = cf.SeriesWriter(path, self.stats.groups, STAT_METRICS, chunk)
+
+    def close_series(self):
+        if self.series is not None:
+            self.series.close()
+            self.series = None
+
+    def write_stats(self, fp, metric='usage'):
+        """ Write the @metric history kept so far as CSV, a row per sample """
+        groups = self.display_order()
+        fp.write(",".join(['time'] + groups) + "\n")
+        skip = self.stats.size - len(self.stats)
+        data = self.stats.ordered(metric, groups)[:, skip:].T
+        for t, row in zip(self.stats.times()[skip:], data.tolist()):
+            fp.write(",".join(str(x) for x in [int(t)] + row) + "\n")
+
+    def reset_timing(self):
+        """ Zero the cumulative wall time and number of calls per phase """
+        self.phase_time = dict.fromkeys(PHASES, 0.0)
+        self.phase_calls = dict.fromkeys(PHASES, 0)
+        self._profilers = {}
+
+    def profile_phase(self, phase):
+        """ Run @phase under cProfile from now on, see profile_stats() """
+        if phase not in PHASES:
+            raise ValueError("Unknown phase %s" % phase)
+        self._profilers.setdefault(phase, cProfile.Profile())
+
+    def profile_stats(self, phase, stream=None):
+        """ pstats.Stats of a phase being profiled """
+        return pstats.Stats(self._profilers[phase], stream=stream)
+
+    def _phase(self, phase, fn, *args):
+        """ Call fn(*args) accounting its wall time to @phase """
+        start = time.time()
+        profiler = self._profilers.get(phase)
+        if profiler is None:
+            fn(*args)
+        else:
+            profiler.runcall(fn, *args)
+        self.phase_time[phase] += time.time() - start
+        self.phase_calls[phase] += 1
+
+    def timing(self):
+        """ Per-phase wall time and calls plus the negotiation counters """
+        return {
+            'phase_time': dict(self.phase_time),
+            'phase_calls': dict(self.phase_calls),
+            'negotiation': self.farm.negotiation_stats(),
+        }
+
+    def report_timing(self, fp):
+        """ Write a human readable summary of timing() to @fp """
+        total = sum(self.phase_time.values())
+        fp.write("%-16s %10s %10s %8s\n" % ('phase', 'seconds', 'calls', '%'))
+        for phase in PHASES:
+            t = self.phase_time[phase]
+            fp.write("%-16s %10.3f %10d %7.1f%%\n" % (phase, t, self.phase_calls[phase],
+                                                     100.0 * t / total if total else 0))
+        for key, value in sorted(self.farm.negotiation_stats().items()):
+            fp.write("%-20s %12.6g\n" % (key, value))
+        for phase in sorted(self._profilers):
+            fp.write("\nProfile of %s:\n" % phase)
+            self.profile_stats(phase, fp).sort_stats('cumulative').print_stats(25)
+
+    def set_seed(self, seed):
+        """ Restart the per-group random streams from @seed (None: random) """
+        self.seed = seed
+        self._rngs = {}
+
+    def _rng(self, name):
+        """ The random stream of group @name, derived from the seed and the
+            group name so it doesn't depend on which other groups exist
+        """
+        try:
+            return self._rngs[name]
+        except KeyError:
+            if self.seed is None:
+                rng = np.random.RandomState()
+            else:
+                rng = np.random.RandomState([self.seed, zlib.crc32(name) & 0xffffffff])
+            self._rngs[name] = rng
+            return rng
+
+    @classmethod
+    def setup_groups(cls, root, spec=None):
+        """ Build the group tree below @root from @spec, a mapping of
+            {name: properties} where the properties are the group's "quota"
+            and "surplus", its "children" (another such mapping) and, for
+            leaf groups, the job characteristics of Group.set_character.
+            Leaves without those take default_queue_properties.
+
+            Without @spec the tree reflects current ATLAS group structure:
 
          /- atlas +-- production +-- prod
          |        |              |
@@ -112,6 +448,10 @@ class Simulation(object):
 
         """
 
+        if spec is not None:
+            cls._add_groups(root, spec)
+            return root
+
         root.add_child('atlas')
         root.add_child('grid', 3)
         root['atlas'].add_child('production')
@@ -128,60 +468,187 @@ class Simulation(object):
                 x.set_character(**default_queue_properties[x.name])
         return root
 
+    @classmethod
+    def _add_groups(cls, parent, spec):
+        for name, props in spec.iteritems():
+            name = str(name)
+            props = dict((str(k), v) for k, v in props.iteritems())
+            parent.add_child(name, quota=props.pop('quota', 0),
+                             surplus=props.pop('surplus', False))
+            children = props.pop('children', None)
+            if children:
+                cls._add_groups(parent[name], children)
+            else:
+                character = dict(default_queue_properties.get(name, {}))
+                character.update(props)
+                parent[name].set_character(**character)
+
     def add_jobs(self):
         """ Submit more jobs into the queue, keeping the total idle jobs where
             they should be according to the sliders in the GUI.
         """
 
         for group in self.farm.groups.active_groups():
-            num_submit = group.num - self.farm.queue.get_group_idle(group.name)
+            num_submit = group.num - group.idle
 
             if num_submit <= 0:
                 continue
 
             log.info("Submitting %d more %s jobs", num_submit, group.name)
 
-            for n in xrange(num_submit):
-                # Job length is random within a Gaussian distribution
-                length = abs(random.gauss(group.avg, group.std))
+            # Job lengths are drawn all at once from the group's distribution
+            lengths = group.draw_lengths(self._rng(group.name), num_submit)
 
-                # Create job object and add it to queue
-                job = cf.BatchJob(group=group.name, cpus=group.cpu, memory=group.mem,
-                                  length=length)
-                self.queue.add_job(job)
+            # Jobs go straight into the queue's table, no objects are made
+            self.queue.submit(group.name, num_submit, cpus=group.cpu or 1,
+                              memory=group.mem, length=lengths)
+
+    def replay(self, source, columns=None):
+        """ Submit the jobs of a real batch system's accounting log as the
+            simulation reaches their submit times, the first one now, on top
+            of any jobs add_jobs() submits.
+
+            @source is a path to a .csv or .jsonl file (see
+            computefarm.read_log, @columns maps the field names) or an
+            iterable of (submit, group, cpus, memory, runtime) records. It is
+            read as the simulation goes, never all at once. Jobs of groups
+            that aren't leaves of the group tree are skipped.
+        """
+        if isinstance(source, basestring):
+            source = cf.read_log(source, columns)
+        self.workload = cf.Replay(source, start=self.farm.time,
+                                  groups=set(x.name for x in self.farm.groups.active_groups()))
+
+    def _replay_due(self):
+        """ Time of the tick at which the next replayed job is submitted """
+        if self.workload is None:
+            return None
+        t = self.workload.next_time()
+        return quantize(t, self.sec_per_step) if t is not None else None
+
+    def _replay_jobs(self):
+        self.workload.submit_until(self.queue, self.farm.time)
+
+    def set_event_driven(self, enabled=True):
+        """ In event-driven mode time jumps straight to the next job completion,
+            submission, negotiation or statistics event instead of ticking
+            through every machine and job each sec_per_step seconds.
+
+            Event times are rounded to sec_per_step so the schedule produced is
+            the same as with the tick loop.
+        """
+        if not enabled:
+            self.farm.set_event_driven(False)
+            self.events = None
+            return
+
+        self.farm.set_event_driven(True, self.sec_per_step)
+        self.events = cf.EventQueue()
+        self._schedule(SUBMIT, self.next_submit)
+        self._schedule(NEGOTIATE, self.next_negotiate)
+        self._schedule(STAT, self.next_stat)
+
+    def _schedule(self, kind, after):
+        """ Schedule @kind at the first step a tick loop would handle it """
+        self.events.push(first_tick_after(after, self.sec_per_step), kind)
+
+    def run_until(self, end):
+        """ Process events in time order until simulation time @end, or
+            until steady state if detect_steady_state() says to stop there
+        """
+
+        farm = self.farm
+        events = self.events
+        self.stopped = False
+
+        while True:
+            when = events.next_time()
+            completion = farm.next_completion()
+            if completion is not None and completion < when:
+                when = completion
+            replay = self._replay_due()
+            if replay is not None and replay < when:
+                when = replay
+            if when > end:
+                break
+
+            self._phase('advance_time', farm.advance_to, when)
+
+            if replay == when:
+                self._phase('add_jobs', self._replay_jobs)
+
+            while events.next_time() == when:
+                _, kind, _ = events.pop()
+                if kind == SUBMIT:
+                    self._phase('add_jobs', self.add_jobs)
+                    self.next_submit = when + self.int_submit
+                    self._schedule(SUBMIT, self.next_submit)
+                elif kind == NEGOTIATE:
+                    self._phase('negotiate_jobs', farm.negotiate_jobs)
+                    self.next_negotiate = when + self.int_negotiate
+                    self._schedule(NEGOTIATE, self.next_negotiate)
+                elif kind == STAT:
+                    self._phase('_update_stat', self._update_stat)
+                    self.next_stat = when + self.int_stat
+                    self._schedule(STAT, self.next_stat)
+
+            if self.stopped:
+                return
+
+        self._phase('advance_time', farm.advance_to, end)
 
     def step(self, dt):
         """ Advance time of the simulation by dt steps at a time, making next
-            submission/negotiation/statistics-gathering as appropriate
+            submission/negotiation/statistics-gathering as appropriate, or
+            until steady state if detect_steady_state() says to stop there
         """
 
+        if self.events is not None:
+            self.run_until(self.farm.time + dt * self.sec_per_step)
+            return
+
+        self.stopped = False
         for i in xrange(dt):
 
-            self.farm.advance_time(self.sec_per_step)
+            self._phase('advance_time', self.farm.advance_time, self.sec_per_step)
+
+            replay = self._replay_due()
+            if replay is not None and replay <= self.farm.time:
+                self._phase('add_jobs', self._replay_jobs)
 
             if self.farm.time > self.next_submit:
-                self.add_jobs()
+                self._phase('add_jobs', self.add_jobs)
                 self.next_submit = self.farm.time + self.int_submit
 
             if self.farm.time > self.next_negotiate:
-                self.farm.negotiate_jobs()
+                self._phase('negotiate_jobs', self.farm.negotiate_jobs)
                 self.next_negotiate = self.farm.time + self.int_negotiate
 
             if self.farm.time > self.next_stat:
-                self._update_stat()
+                self._phase('_update_stat', self._update_stat)
                 self.next_stat = self.farm.time + self.int_stat
+                if self.stopped:
+                    break
 
     def display_order(self):
         sort_order = ('short', 'long', 'test', 'prod', 'mp8')
-        return list(sort_like(self._stat.keys(), sort_order))
+        return list(sort_like(self.stats.groups, sort_order))
 
-    def make_plotdata(self, groups='all'):
+    def make_plotdata(self, groups='all', metric='usage'):
 
         x = np.arange(self._stat_size)
-        if groups == 'all':
-            y = np.vstack((self._stat[x] for x in self.display_order()))
-        else:
-            y = np.vstack((self._stat[x] for x in self.display_order() if x in groups))
+        names = self.display_order()
+        if groups != 'all':
+            names = [g for g in names if g in groups]
+
+        # Copy each row straight out of the two halves of the buffer, the
+        # plot gets an array of its own and nothing else is copied
+        older, newer = self.stats.segments(metric)
+        split = older.shape[1]
+        y = np.empty((len(names), self._stat_size), older.dtype)
+        for n, row in enumerate(self.stats.rows(names)):
+            y[n, :split] = older[row]
+            y[n, split:] = newer[row]
 
         return x, y
 
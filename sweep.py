@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+""" Run a simulation config under several scenarios, each with a number of
+    random seeds, across a pool of processes and write out per-group usage
+    bands (mean and percentiles over the seeds) for every scenario.
+
+    Scenarios are changes to the config given as path=value, the path being
+    the keys down to the setting joined by dots, e.g.
+
+        sweep.py atlas.json --vary ranking=depth_first,breadth_first \\
+            --vary groups.grid.quota=3,6 --seeds 20 -d 2d -o bands.csv
+
+    runs the 4 combinations of the two settings 20 times each.
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+import computefarm as cf
+from simulation import Simulation, STAT_METRICS
+from runsim import parse_duration
+
+log = logging.getLogger('sim')
+
+# Shared array the workers write the sampled series to, see _init_worker
+_samples = None
+
+
+def set_path(config, path, value):
+    """ Copy of @config with the setting at dotted @path set to @value """
+    config = copy.deepcopy(config)
+    keys = path.split('.')
+    node = config
+    for key in keys[:-1]:
+        node = node.setdefault(key, {})
+    node[keys[-1]] = value
+    return config
+
+
+def grid(params):
+    """ Every combination of the values of @params, a list of (path, values),
+        as a list of (name, [(path, value), ...]) scenarios
+    """
+    paths = [p for p, _ in params]
+    scenarios = []
+    for values in itertools.product(*[v for _, v in params]):
+        changes = zip(paths, values)
+        name = " ".join("%s=%s" % (p, v) for p, v in changes)
+        scenarios.append((name or 'base', changes))
+    return scenarios
+
+
+def scenario_config(config, changes):
+    for path, value in changes:
+        config = set_path(config, path, value)
+    return config
+
+
+def _init_worker(shared, shape):
+    global _samples
+    _samples = np.frombuffer(shared, np.float64).reshape(shape)
+
+
+def _run(task):
+    """ One simulation of a sweep, run in a worker """
+    n, config, times, metric, steady = task
+    start = time.time()
+    sim = Simulation.from_config(config)
+    sim.set_event_driven(True)
+    if steady is not None:
+        sim.detect_steady_state(*steady)
+    groups = sim._stat_groups
+    out = _samples[n]
+    for i, t in enumerate(times):
+        sim.run_until(t)
+        out[:len(groups), i] = [getattr(g, metric) or 0 for g in groups]
+        if sim.stopped:
+            # The rest of the run would stay at the steady state means
+            means = sim.steady.means()
+            if metric == 'usage':
+                out[:len(groups), i + 1:] = np.array([[means[g.name]] for g in groups])
+            else:
+                out[:len(groups), i + 1:] = out[:len(groups), i:i + 1]
+            return n, time.time() - start, sim.steady.time
+    return n, time.time() - start, None
+
+
+class Band(object):
+    """ Statistics of one metric of a scenario over its seeds: mean and the
+        requested percentiles, each an array of groups x times, and the
+        individual runs as seeds x groups x times in runs. steady has the
+        time each run reached steady state, None if it didn't or wasn't
+        watched for it.
+    """
+
+    def __init__(self, name, groups, times, runs, percentiles, steady=None):
+        self.name = name
+        self.groups = groups
+        self.times = times
+        self.runs = runs
+        self.steady = steady or [None] * len(runs)
+        self.mean = runs.mean(axis=0)
+        self.percentiles = dict((p, np.percentile(runs, p, axis=0))
+                                for p in percentiles)
+
+
+def run_sweep(config, scenarios, seeds, duration, interval=600, metric='usage',
+              processes=None, percentiles=(10, 50, 90), steady=None):
+    """ Run @config under each of @scenarios, a list of (name, changes) like
+        grid() makes, once for each of @seeds (a list, or a number meaning
+        seeds 0 to seeds - 1), in a pool of @processes (default: number of
+        CPUs) processes. The @metric of every group is sampled each
+        @interval seconds up to @duration.
+
+        With @steady, a tolerance or (window, tolerance) for
+        Simulation.detect_steady_state, runs end at steady state and the
+        rest of their samples are filled in with the steady state usage
+        (or the last sample for other metrics).
+
+        Samples are written by the workers straight into one array in shared
+        memory, so only task descriptions and timings go between processes.
+        Any "shards" in the config is ignored, each run has a plain Farm.
+        Returns a list of a Band per scenario, in order.
+    """
+    if isinstance(seeds, int):
+        seeds = range(seeds)
+    if metric not in STAT_METRICS:
+        raise ValueError("Metric must be one of %s" % ", ".join(STAT_METRICS))
+    times = np.arange(1, int(duration // interval) + 1) * float(interval)
+
+    configs = [scenario_config(config, changes) for _, changes in scenarios]
+    groups = [[g.name for g in Simulation.setup_groups(
+        cf.Group('<root>'), c.get('groups')).active_groups()] for c in configs]
+    if steady is not None and not isinstance(steady, (tuple, list)):
+        steady = (6 * 3600, steady)
+    # The runs are spread over processes already, and pool workers can't
+    # start the workers of a partitioned farm
+    tasks = [(n, dict(c, seed=seed, shards=None), times, metric, steady)
+             for n, (c, seed) in enumerate(itertools.product(configs, seeds))]
+    reached = [None] * len(tasks)
+
+    shape = (len(tasks), max(len(g) for g in groups), len(times))
+    shared = multiprocessing.RawArray('d', int(np.prod(shape)))
+    pool = multiprocessing.Pool(processes, _init_worker, (shared, shape))
+    start = time.time()
+    try:
+        for done, (n, wall, when) in enumerate(pool.imap_unordered(_run, tasks), 1):
+            log.info("Run %d/%d done in %.1fs", done, len(tasks), wall)
+            reached[n] = when
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    log.info("%d runs in %.1fs", len(tasks), time.time() - start)
+
+    samples = np.frombuffer(shared, np.float64).reshape(shape)
+    bands = []
+    for i, (name, _) in enumerate(scenarios):
+        part = slice(i * len(seeds), (i + 1) * len(seeds))
+        bands.append(Band(name, groups[i], times, samples[part, :len(groups[i])].copy(),
+                          percentiles, reached[part]))
+    return bands
+
+
+def write_bands(fp, bands):
+    """ Write @bands as CSV, a row per scenario, group and sample time """
+    pcts = sorted(bands[0].percentiles) if bands else []
+    fp.write(",".join(['scenario', 'group', 'time', 'mean'] +
+                      ['p%g' % p for p in pcts]) + "\n")
+    for band in bands:
+        for g, group in enumerate(band.groups):
+            cols = [band.mean[g]] + [band.percentiles[p][g] for p in pcts]
+            for t, row in zip(band.times.tolist(), zip(*[c.tolist() for c in cols])):
+                fp.write(",".join([band.name, group, str(int(t))] +
+                                  ["%g" % x for x in row]) + "\n")
+
+
+def parse_vary(text):
+    """ (path, values) from 'path=value,value,...', values read as JSON where
+        they can be
+    """
+    path, _, values = text.partition('=')
+    if not values:
+        raise argparse.ArgumentTypeError("Expected path=value,... not %s" % text)
+
+    def value(x):
+        try:
+            return json.loads(x)
+        except ValueError:
+            return x
+    return path, [value(x) for x in values.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', nargs='?',
+                        help='JSON config file (see atlas.json), without one '
+                             'the built-in ATLAS setup is used')
+    parser.add_argument('--vary', metavar='PATH=VALUES', type=parse_vary,
+                        action='append', default=[],
+                        help='comma separated values of a config setting to '
+                             'run with, all combinations are run')
+    parser.add_argument('--seeds', type=int, default=10,
+                        help='runs per scenario, seeded 0, 1, ... (default 10)')
+    parser.add_argument('-d', '--duration', type=parse_duration,
+                        help='simulated time per run (default: "duration" '
+                             'from the config, or 1d)')
+    parser.add_argument('-i', '--interval', type=parse_duration, default=600,
+                        help='time between samples (default 10m)')
+    parser.add_argument('-m', '--metric', default='usage', choices=STAT_METRICS)
+    parser.add_argument('--steady', metavar='TOL', type=float,
+                        help='end runs once usage is steady within TOL of the '
+                             'farm\'s cpus, see runsim.py --steady')
+    parser.add_argument('--steady-window', metavar='TIME', type=parse_duration,
+                        default=6 * 3600,
+                        help='span of time steady state is judged over '
+                             '(default 6h)')
+    parser.add_argument('-j', '--processes', type=int,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('-p', '--percentiles', default='10,50,90',
+                        help='percentiles to write besides the mean')
+    parser.add_argument('-o', '--output', default='-',
+                        help='CSV file for the bands (default: stdout)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.INFO if args.verbose else logging.WARNING,
+                        format="(%(levelname)5s) %(message)s")
+
+    config = {}
+    if args.config:
+        with open(args.config) as fp:
+            config = json.load(fp)
+
+    duration = args.duration
+    if duration is None:
+        duration = parse_duration(config.get('duration', '1d'))
+
+    bands = run_sweep(config, grid(args.vary), args.seeds, duration,
+                      interval=args.interval, metric=args.metric,
+                      processes=args.processes,
+                      steady=(args.steady_window, args.steady)
+                      if args.steady is not None else None,
+                      percentiles=[float(x) for x in args.percentiles.split(',')])
+
+    if args.steady is not None:
+        for band in bands:
+            reached = [t for t in band.steady if t is not None]
+            sys.stderr.write("%s: %d/%d runs steady, mean t=%s\n" % (
+                band.name, len(reached), len(band.steady),
+                "%d" % np.mean(reached) if reached else '-'))
+
+    if args.output == '-':
+        write_bands(sys.stdout, bands)
+    else:
+        with open(args.output, 'w') as fp:
+            write_bands(fp, bands)
+
+
+if __name__ == '__main__':
+    main()
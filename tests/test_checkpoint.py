@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+import io
+import unittest
+
+from simulation import Simulation
+
+HOUR = 60 * 60
+
+
+def stats_text(sim):
+    out = io.BytesIO()
+    sim.write_stats(out)
+    return out.getvalue()
+
+
+class CheckpointTest(unittest.TestCase):
+    """ A simulation saved and loaded, or forked, carries on as the
+        original does
+    """
+
+    def make_sim(self, event_driven=True):
+        sim = Simulation.from_config({'nodes': 60, 'seed': 7})
+        sim.set_event_driven(event_driven)
+        return sim
+
+    def run_for(self, sim, duration):
+        if sim.events is not None:
+            sim.run_until(sim.farm.time + duration)
+        else:
+            sim.step(int(duration // sim.sec_per_step))
+
+    def check_restored(self, event_driven):
+        sim = self.make_sim(event_driven)
+        self.run_for(sim, 2 * HOUR)
+        buf = io.BytesIO()
+        sim.save(buf)
+        buf.seek(0)
+        restored = Simulation.load(buf)
+
+        self.run_for(sim, 2 * HOUR)
+        self.run_for(restored, 2 * HOUR)
+        self.assertEqual(restored.farm.time, sim.farm.time)
+        self.assertEqual(stats_text(restored), stats_text(sim))
+        self.assertEqual(str(restored.farm), str(sim.farm))
+
+    def test_save_load_event_driven(self):
+        self.check_restored(True)
+
+    def test_save_load_ticks(self):
+        self.check_restored(False)
+
+    def test_fork(self):
+        sim = self.make_sim()
+        self.run_for(sim, HOUR)
+        forked = sim.fork()
+        self.run_for(forked, HOUR)
+        self.assertEqual(sim.farm.time, HOUR)
+        self.run_for(sim, HOUR)
+        self.assertEqual(stats_text(forked), stats_text(sim))
+
+    def test_load_then_detect_steady_state(self):
+        sim = self.make_sim()
+        self.run_for(sim, HOUR)
+        restored = sim.fork()
+        self.assertIsNone(restored.steady)
+        self.assertFalse(restored.stopped)
+        restored.detect_steady_state(HOUR, 0.5)
+        self.run_for(restored, 4 * HOUR)
+        self.assertTrue(restored.steady.reached)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import itertools
+import unittest
+
+import computefarm as cf
+from computefarm.events import EventQueue, COMPLETE, SUBMIT, NEGOTIATE, STAT, \
+    quantize, first_tick_after
+from simulation import Simulation
+
+HOUR = 60 * 60
+
+
+def run(event_driven, switch_at=None):
+    """ Stats, farm and negotiation trace after 6h run in ticks or events,
+        or switching to that mode from the other at @switch_at
+    """
+    cf.Machine._ids = itertools.count(0)
+    sim = Simulation.from_config({'nodes': 40, 'seed': 2})
+    sim.farm.trace = cf.Trace(size=10 ** 6)
+    end = 6 * HOUR
+    for mode, until in ((not event_driven, switch_at), (event_driven, end)):
+        if until is None:
+            continue
+        sim.set_event_driven(mode)
+        if mode:
+            sim.run_until(until)
+        else:
+            sim.step(int((until - sim.farm.time) // sim.sec_per_step))
+    return (sim.stats.ordered('usage').tolist(), sim.stats.times().tolist(),
+            str(sim.farm), list(sim.farm.trace.render()))
+
+
+class EventDrivenTest(unittest.TestCase):
+    """ Jumping between events gives exactly the schedule of the tick loop """
+
+    def test_same_schedule(self):
+        ticks = run(False)
+        self.assertEqual(run(True), ticks)
+
+    def test_switching_modes(self):
+        ticks = run(False)
+        self.assertEqual(run(True, switch_at=2 * HOUR), ticks)
+        self.assertEqual(run(False, switch_at=2 * HOUR), ticks)
+
+
+class EventQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        events = EventQueue()
+        events.push(10, STAT, 'a')
+        events.push(10, COMPLETE, 'b')
+        events.push(5, NEGOTIATE, 'c')
+        events.push(10, COMPLETE, 'd')
+        events.push(10, SUBMIT, 'e')
+        self.assertEqual([events.pop()[2] for _ in xrange(len(events))],
+                         ['c', 'b', 'd', 'e', 'a'])
+        self.assertIsNone(events.next_time())
+
+    def test_rounding(self):
+        self.assertEqual(quantize(11, 5), 15)
+        self.assertEqual(quantize(10, 5), 10)
+        self.assertEqual(quantize(10.5, 0), 10.5)
+        self.assertEqual(first_tick_after(10, 5), 15)
+        self.assertEqual(first_tick_after(11, 5), 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+import itertools
+import unittest
+
+import computefarm as cf
+from computefarm.farm import JobWouldViolate
+from simulation import Simulation
+
+HOUR = 60 * 60
+
+# A small farm of mixed machines, overfull with jobs of mixed shapes, with
+# groups taking surplus from their parents
+CONFIG = {'nodes': 80, 'seed': 2, 'farm': [[8, 2], [24, 1], [32, 1]], 'groups': {
+    'single': {'quota': 3, 'surplus': True, 'num': 150, 'avg': HOUR, 'std': 1200},
+    'multi': {'quota': 1, 'num': 60, 'avg': 2 * HOUR, 'std': 1800,
+              'cpu': 8, 'mem': 12000},
+    'lhc': {'surplus': True, 'children': {
+        'himem': {'quota': 1, 'surplus': True, 'num': 60, 'avg': HOUR, 'std': 600,
+                  'mem': 7000},
+        'triple': {'quota': 2, 'num': 60, 'avg': 3 * HOUR, 'std': 600, 'cpu': 3}}}}}
+
+
+def job_by_job(farm, group, demand, cpus, memory, rows):
+    """ Farm.negotiate_cluster the plain way, each job admitted and placed on
+        its own
+    """
+    for job in list(farm.queue._jobs(rows)):
+        try:
+            farm.allowed_run(job, group, demand)
+        except JobWouldViolate:
+            continue
+        machine = farm.best_slot(job)
+        if machine is None:
+            # Nor for the rest, nothing ends during negotiation
+            break
+        farm.start_job(machine, job)
+        parent = group.parent
+        while parent:
+            parent.surplus -= farm.slotweight(job)
+            parent = parent.parent
+
+
+def schedule(ranking, negotiate=None):
+    """ The farm and usage history after 6h with the negotiator's autocluster
+        matching replaced by @negotiate
+    """
+    cf.Machine._ids = itertools.count(0)
+    real = cf.Farm.negotiate_cluster
+    if negotiate is not None:
+        cf.Farm.negotiate_cluster = negotiate
+    try:
+        sim = Simulation.from_config(dict(CONFIG, ranking=ranking))
+        sim.set_event_driven(True)
+        sim.run_until(6 * HOUR)
+    finally:
+        cf.Farm.negotiate_cluster = real
+    sim.farm.check_counters()
+    return str(sim.farm), sim.stats.ordered('usage').tolist(), sim.farm.negotiation_stats()
+
+
+class CounterTest(unittest.TestCase):
+    """ The live group counters against a full recount of the queue """
+
+    def test_queue_without_groups(self):
+        farm = cf.Farm()
+        farm.add_machines(8, 2)
+        queue = cf.JobQueue()
+        farm.attach_queue(queue)
+        queue.add_job(cf.BatchJob(cpus=2, group='grid'))
+        queue.submit('grid', 10, cpus=1)
+        farm.check_counters()
+        self.assertEqual(queue.count_jobs(), 11)
+
+    def test_counters_match_recount(self):
+        sim = Simulation.from_config({'nodes': 40, 'seed': 3})
+        sim.set_event_driven(True)
+        for t in xrange(1, 7):
+            sim.run_until(t * HOUR)
+            sim.farm.check_counters()
+
+
+class NegotiationTest(unittest.TestCase):
+    """ Matching whole autoclusters at once schedules exactly as matching
+        each job on its own
+    """
+
+    def test_same_as_job_by_job(self):
+        rejected = no_slot = 0
+        for ranking in ('depth_first', 'breadth_first', 'largest_first', 'best_fit',
+                        'multicore', {'weighted': [['best_fit', 1], ['breadth_first', 2]]}):
+            farm, usage, stats = schedule(ranking)
+            self.assertEqual((farm, usage), schedule(ranking, job_by_job)[:2], ranking)
+            rejected += stats['rejected']
+            no_slot += stats['no_slot']
+        # Jobs were held back by quota as well as by a full farm
+        self.assertTrue(rejected and no_slot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import itertools
+import unittest
+
+import computefarm as cf
+from simulation import Simulation
+
+HOUR = 60 * 60
+
+# Small enough that the farm fills up and placement matters
+CONFIG = {'nodes': 30, 'seed': 4, 'groups': {
+    'single': {'quota': 2, 'surplus': True, 'num': 300, 'avg': HOUR, 'std': 1200},
+    'multi': {'quota': 1, 'num': 60, 'avg': 3 * HOUR, 'std': 1800, 'cpu': 8,
+              'mem': 6000}}}
+
+
+def run(config, event_driven=True, trace=False):
+    """ (farm description, stats, negotiation counts, trace) after 4h """
+    # Name the machines of each farm alike
+    cf.Machine._ids = itertools.count(0)
+    sim = Simulation.from_config(config)
+    try:
+        if trace:
+            sim.farm.trace = cf.Trace(size=10 ** 6)
+        sim.set_event_driven(event_driven)
+        if event_driven:
+            sim.run_until(4 * HOUR)
+        else:
+            sim.step(4 * HOUR // sim.sec_per_step)
+        sim.farm.check_counters()
+        stats = sim.stats.ordered('usage').tolist()
+        neg = sim.farm.negotiation_stats()
+        return (str(sim.farm), stats, neg,
+                list(sim.farm.trace.render()) if trace else None)
+    finally:
+        sim.farm.close()
+
+
+class PartitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._debug = cf.Farm.debug_counters
+        cf.Farm.debug_counters = True
+
+    def tearDown(self):
+        cf.Farm.debug_counters = self._debug
+
+    def test_one_shard_is_a_farm(self):
+        for event_driven in (True, False):
+            for ranking in ('depth_first', 'breadth_first', 'best_fit'):
+                config = dict(CONFIG, ranking=ranking)
+                self.assertEqual(run(dict(config, shards=1), event_driven, True),
+                                 run(config, event_driven, True),
+                                 (ranking, event_driven))
+
+    def test_many_shards(self):
+        farm, _, neg, _ = run(CONFIG)
+        for shards in (2, 3):
+            sharded, _, sharded_neg, _ = run(dict(CONFIG, shards=shards))
+            # The same machines, filled up as far as quotas let them
+            self.assertEqual(sharded.count('\n'), farm.count('\n'))
+            self.assertEqual(sharded_neg['cycles'], neg['cycles'])
+            self.assertGreater(sharded_neg['matches'], 0)
+
+    def test_batch_split(self):
+        # Alike machines, so the two workers have as many slots each
+        cf.Machine._ids = itertools.count(0)
+        sim = Simulation.from_config({'nodes': 20, 'farm': [[8, 1]], 'shards': 2,
+                                      'groups': {'a': {'quota': 1, 'num': 40}}})
+        try:
+            sim.add_jobs()
+            sim.farm.negotiate_jobs()
+            shards = [job.node % 2 for job in sim.queue.match_jobs({'state': cf.RUNNING})]
+            self.assertEqual(sorted(shards), [0] * 20 + [1] * 20)
+        finally:
+            sim.farm.close()
+
+    def test_refuses_callback(self):
+        farm = cf.PartitionedFarm(1)
+        try:
+            self.assertRaises(cf.BatchExcept, farm.set_negotiatior_rank,
+                              lambda m: m.cpus)
+            self.assertRaises(cf.BatchExcept, farm.get_state)
+        finally:
+            farm.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+import unittest
+
+import numpy as np
+
+import computefarm as cf
+from computefarm import IDLE, RUNNING
+from computefarm.job import JobTable, FREE
+
+
+class JobTableTest(unittest.TestCase):
+
+    def test_compact_moves_pinned_views(self):
+        table = JobTable(4)
+        first = table.append(8, cpus=np.arange(8), state=IDLE)
+        kept = cf.BatchJob.view(table, first + 5)
+        table.pinned[kept._handle] = kept
+        for row in (0, 1, 3, 4):
+            table.free(row)
+        epoch = table.epoch
+        table.compact()
+        self.assertEqual(table.epoch, epoch + 1)
+        self.assertEqual(table.size, 4)
+        self.assertEqual(table.cpus[:table.size].tolist(), [2, 5, 6, 7])
+        self.assertEqual(kept.cpus, 5)
+        self.assertEqual(table.pinned, {kept._handle: kept})
+        self.assertNotIn(FREE, table.state[:table.size].tolist())
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def test_counts_follow_jobs(self):
+        queue = cf.JobQueue()
+        queue.submit('a', 5, cpus=2, length=100)
+        queue.submit('b', 3)
+        job = cf.BatchJob(cpus=4, group='a')
+        queue.add_job(job)
+        self.assertEqual(queue.count_jobs('a', IDLE), 6)
+        self.assertEqual(queue.count_jobs(), 9)
+
+        job.state = RUNNING
+        self.assertEqual(queue.count_jobs('a', IDLE), 5)
+        self.assertEqual(queue.count_jobs('a', RUNNING), 1)
+        job.finish()
+        self.assertNotIn(job, queue)
+        self.assertEqual(queue.count_jobs('a'), 5)
+        self.assertEqual(job.cpus, 4)
+
+    def test_autoclusters(self):
+        queue = cf.JobQueue()
+        queue.submit('a', 2, cpus=1)
+        queue.submit('a', 2, cpus=8, memory=6000)
+        queue.submit('a', 1, cpus=1)
+        queue.submit('b', 1, cpus=1)
+        clusters = [(c, m, rows.tolist()) for c, m, rows in queue.autoclusters('a')]
+        self.assertEqual(clusters, [(1, 2000, [0, 1, 4]), (8, 6000, [2, 3])])
+        self.assertEqual(queue.autoclusters('nothing'), [])
+
+    def test_table_grows_and_compacts(self):
+        queue = cf.JobQueue()
+        running = []
+        for n in xrange(50):
+            queue.submit('a', 20, length=n)
+            for job in list(queue)[:10]:
+                if job.state == IDLE:
+                    job.state = RUNNING
+                    running.append(job)
+            for job in list(queue)[:15]:
+                if job.state == IDLE:
+                    queue.remove(job)
+        self.assertGreater(queue.table.epoch, 0)
+        self.assertEqual(len(queue), len(running) + queue.count_jobs('a', IDLE))
+        self.assertTrue(all(job.queue is queue and job.state == RUNNING
+                            for job in running))
+
+
+if __name__ == '__main__':
+    unittest.main()
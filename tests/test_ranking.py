@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import random
+import unittest
+
+import computefarm as cf
+from computefarm.ranking import rankings, from_spec
+
+SHAPES = [(1, 0), (1, 2000), (2, 4000), (3, 1000), (8, 6000), (8, 16000),
+          (12, 24000), (24, 48000), (40, 1000)]
+
+
+def scan(farm, policy, job):
+    """ The best machine for @job the slow way, max() over fitting ones """
+    try:
+        return max(farm.get_slots_fitting(job), key=lambda m: policy.key(m, job))
+    except ValueError:
+        return None
+
+
+class RankingTest(unittest.TestCase):
+    """ Every way of picking the best slot agrees on a partly filled farm """
+
+    def setUp(self):
+        rng = random.Random(5)
+        self.farm = cf.Farm()
+        for cpus in (8, 24, 32, 8, 24):
+            self.farm.add_machines(cpus, 6)
+        for machine in self.farm:
+            for _ in xrange(rng.randint(0, 6)):
+                cpus = rng.choice([1, 1, 2, 4, 8])
+                if machine.cpus >= cpus and machine.memory >= cpus * 2000:
+                    self.farm.start_job(machine, cf.BatchJob(cpus=cpus))
+
+    def best(self, policy, job, index):
+        self.farm.set_negotiatior_rank(policy)
+        self.farm.use_slot_index = index
+        try:
+            return self.farm.best_slot(job)
+        finally:
+            self.farm.use_slot_index = True
+
+    def check(self, policy):
+        for cpus, memory in SHAPES:
+            job = cf.BatchJob(cpus=cpus, memory=memory)
+            ranking = from_spec(policy)
+            expect = scan(self.farm, ranking, job)
+            if expect is not None:
+                self.assertIs(max(self.farm.get_slots_fitting(job),
+                                  key=ranking.keys(self.farm._table, job)), expect)
+            self.assertIs(self.best(policy, job, True), expect, (policy, cpus, memory))
+            self.assertIs(self.best(policy, job, False), expect, (policy, cpus, memory))
+
+    def test_builtin(self):
+        for name in sorted(rankings):
+            self.check(name)
+
+    def test_multicore_cores(self):
+        self.check({'multicore': 4})
+
+    def test_weighted(self):
+        self.check({'weighted': [['best_fit', 1], ['breadth_first', 3]]})
+
+    def test_callback(self):
+        self.check(lambda m: m.memory)
+
+    def test_farm_names(self):
+        from computefarm.farm import depth_first, breadth_first, largest_first
+        for policy in (depth_first, breadth_first, largest_first):
+            self.farm.set_negotiatior_rank(policy)
+            self.assertIs(self.farm._jobsorter, rankings[policy.name])
+        self.check(breadth_first)
+
+    def test_score_only(self):
+        class MostMemory(cf.Ranking):
+            def score(self, table, job):
+                return table.memory[:table.size]
+
+        self.assertIsNone(MostMemory().lookup(self.farm._slots, None))
+        self.check(MostMemory())
+
+
+class SlotIndexTest(unittest.TestCase):
+    """ The index keeps up with jobs of mixed memory starting and ending """
+
+    def check_index(self, slots):
+        self.assertEqual(sorted(slots._frees), slots._frees)
+        self.assertEqual(set(slots._frees), set(f for _, f in slots._cells))
+        for (total, free), cell in slots._cells.iteritems():
+            self.assertTrue(cell)
+            self.assertEqual(slots._memories[total, free], sorted(cell))
+            self.assertIn(total, slots._by_free[free])
+            self.assertIn(free, slots._by_total[total])
+            self.assertTrue(all(cell.values()))
+
+    def test_random_updates(self):
+        rng = random.Random(11)
+        farm = cf.Farm()
+        for cpus, memory in ((8, 16000), (24, 48000), (24, 64000), (32, 64000), (8, 32000)):
+            farm.add_machines(cpus, 5, memory)
+        machines = list(farm)
+        running = []
+        for n in xrange(600):
+            if running and rng.random() < 0.4:
+                machine, job = running.pop(rng.randrange(len(running)))
+                machine.end_job(job)
+            else:
+                job = cf.BatchJob(cpus=rng.choice([1, 2, 4, 8]),
+                                  memory=rng.choice([500, 2000, 3000, 7000]))
+                machine = rng.choice(machines)
+                if machine.cpus >= job.cpus and machine.memory >= job.memory:
+                    farm.start_job(machine, job)
+                    running.append((machine, job))
+            if n % 20:
+                continue
+            self.check_index(farm._slots)
+            for cpus, memory in SHAPES:
+                job = cf.BatchJob(cpus=cpus, memory=memory)
+                for name in ('depth_first', 'breadth_first', 'largest_first', 'multicore'):
+                    policy = from_spec(name)
+                    self.assertIs(policy.lookup(farm._slots, job), scan(farm, policy, job),
+                                  (name, cpus, memory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+import unittest
+
+import numpy as np
+
+import computefarm as cf
+from simulation import Simulation, HOUR
+
+
+class StatStoreTest(unittest.TestCase):
+
+    def filled(self, samples):
+        store = cf.StatStore(['a', 'b', 'c'], 5, ('usage', 'idle'))
+        for t in xrange(1, samples + 1):
+            store.append(t, [[t, 10 * t, 100 * t], [-t, -t, -t]])
+        return store
+
+    def test_ordered(self):
+        for samples in (0, 3, 5, 7, 12):
+            store = self.filled(samples)
+            times = store.times()
+            expect = np.where(times > 0, times, 0)
+            self.assertEqual(times.tolist(), sorted(times.tolist()))
+            usage = store.ordered()
+            self.assertEqual(usage[0].tolist(), expect.tolist())
+            self.assertEqual(usage[2].tolist(), (100 * expect).tolist())
+            self.assertEqual(store.ordered('usage', ['c', 'a']).tolist(),
+                             usage[[2, 0]].tolist())
+            older, newer = store.segments()
+            self.assertEqual(np.hstack((older, newer)).tolist(), usage.tolist())
+            self.assertEqual(len(store), min(samples, 5))
+
+    def test_plotdata(self):
+        sim = Simulation.from_config({'nodes': 20, 'seed': 1,
+                                      'intervals': {'stat': 1}})
+        sim.set_event_driven(True)
+        for end in (200, 500, 800):
+            sim.run_until(end)
+            x, y = sim.make_plotdata()
+            self.assertEqual(y.tolist(),
+                             sim.stats.ordered('usage', sim.display_order()).tolist())
+            self.assertEqual(len(x), y.shape[1])
+            x, y = sim.make_plotdata(['long', 'short'])
+            self.assertEqual(y.tolist(),
+                             sim.stats.ordered('usage', ['short', 'long']).tolist())
+
+
+class SteadyStateTest(unittest.TestCase):
+
+    def sim(self, step, event_driven):
+        sim = Simulation.from_config({'nodes': 20, 'seed': 1,
+                                      'intervals': {'stat': 10, 'step': step}})
+        sim.set_event_driven(event_driven)
+        return sim
+
+    def test_window_span(self):
+        # With any spread allowed steady state is reached as soon as the
+        # batches span the window
+        for step in (5, 7):
+            for event_driven in (True, False):
+                sim = self.sim(step, event_driven)
+                sim.detect_steady_state(2 * HOUR, tolerance=1.0)
+                sim.step(4 * HOUR // step)
+                self.assertTrue(sim.stopped)
+                interval = sim.stat_interval()
+                self.assertEqual(interval, 14 if step == 7 else 15)
+                self.assertAlmostEqual(sim.steady.time, 2 * HOUR, delta=5 * interval,
+                                       msg=(step, event_driven))
+
+    def test_coarsen(self):
+        for event_driven in (True, False):
+            sim = self.sim(5, event_driven)
+            sim.detect_steady_state(HOUR, tolerance=1.0, coarsen=3)
+            sim.step(2 * HOUR // 5)
+            times = sim.stats.times()
+            times = times[times > sim.steady.time]
+            self.assertEqual(set(np.diff(times).tolist()), set([45]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import sweep
+from simulation import Simulation
+
+HOUR = 60 * 60
+
+CONFIG = {'nodes': 30, 'groups': {
+    'a': {'quota': 2, 'num': 40, 'avg': HOUR, 'std': 600},
+    'b': {'surplus': True, 'children': {
+        'c': {'quota': 1, 'num': 40, 'avg': 2 * HOUR, 'std': 600},
+        'd': {'quota': 1, 'num': 40, 'avg': HOUR, 'std': 600, 'cpu': 2}}}}}
+
+
+class SweepTest(unittest.TestCase):
+
+    def test_bands_match_direct_runs(self):
+        scenarios = sweep.grid([('groups.a.quota', [2, 4])])
+        bands = sweep.run_sweep(CONFIG, scenarios, 2, 2 * HOUR, interval=HOUR,
+                                processes=2)
+        self.assertEqual([b.name for b in bands],
+                         ['groups.a.quota=2', 'groups.a.quota=4'])
+
+        sim = Simulation.from_config(dict(CONFIG, seed=1))
+        sim.set_event_driven(True)
+        usage = []
+        for t in (HOUR, 2 * HOUR):
+            sim.run_until(t)
+            usage.append(dict((g.name, g.usage) for g in sim.farm.groups.active_groups()))
+        band = bands[0]
+        self.assertEqual(band.groups, list(sim.stats.groups))
+        for g, name in enumerate(band.groups):
+            self.assertEqual(band.runs[1, g].tolist(), [u[name] for u in usage])
+
+    def test_shards_ignored(self):
+        bands = sweep.run_sweep(dict(CONFIG, shards=2), sweep.grid([]), 1, HOUR,
+                                interval=HOUR, processes=1)
+        self.assertEqual(bands[0].runs.shape, (1, 3, 1))
+
+    def test_steady_zero_tolerance(self):
+        seen = {}
+
+        def run_sweep(*args, **kwargs):
+            seen.update(kwargs)
+            return []
+
+        tmp = tempfile.mkdtemp()
+        real = sweep.run_sweep
+        try:
+            path = os.path.join(tmp, 'config.json')
+            with open(path, 'w') as fp:
+                json.dump(CONFIG, fp)
+            sweep.run_sweep = run_sweep
+            sweep.main([path, '--steady', '0', '--steady-window', '2h',
+                        '-o', os.path.join(tmp, 'out.csv')])
+        finally:
+            sweep.run_sweep = real
+            shutil.rmtree(tmp)
+        self.assertEqual(seen['steady'], (2 * HOUR, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
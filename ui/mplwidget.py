@@ -1,12 +1,41 @@
 #!/usr/bin/python
 
+import numpy as np
 from PyQt4 import QtGui
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 
+from matplotlib.collections import PolyCollection
 from matplotlib.figure import Figure
 
 
+def downsample(x, curves, width):
+    """ Reduce @curves (rows over @x) to two points, the min and the max, per
+        bucket of samples, @width buckets in all, if there are more samples
+        than that. Returns the new (x, curves).
+    """
+    n = len(x)
+    if n <= 2 * width:
+        return x, curves
+    edges = np.linspace(0, n, width + 1).astype(int)
+    starts, ends = edges[:-1], edges[1:] - 1
+    low = np.minimum.reduceat(curves, starts, axis=1)
+    high = np.maximum.reduceat(curves, starts, axis=1)
+    xs = np.empty(2 * width)
+    xs[0::2], xs[1::2] = x[starts], x[ends]
+    out = np.empty((len(curves), 2 * width))
+    out[:, 0::2], out[:, 1::2] = low, high
+    return xs, out
+
+
 class MplCanvas(FigureCanvas):
+    """ A canvas showing a stacked area plot that is updated in place.
+
+        The areas are animated artists kept from one update to the next and
+        drawn over a saved copy of the rest of the axes, so an update costs
+        the same however long the history is: no more points are drawn than
+        the axes are pixels wide. The whole figure is only redrawn when the
+        y-axis has to be rescaled or the window is resized.
+    """
 
     def __init__(self):
         self.fig = Figure()
@@ -16,6 +45,58 @@ class MplCanvas(FigureCanvas):
         FigureCanvas.setSizePolicy(self, QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
 
+        self._layers = []
+        self._background = None
+        self._xlim = None
+        self.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # Keep the axes without the areas to draw them over on updates
+        self._background = self.copy_from_bbox(self.ax.bbox)
+        self._draw_layers()
+
+    def _draw_layers(self):
+        for layer in self._layers:
+            self.ax.draw_artist(layer)
+
+    def set_layers(self, colors):
+        """ Make one area per color, listed from the bottom up """
+        for layer in self._layers:
+            layer.remove()
+        self._layers = [PolyCollection([], facecolors=c, edgecolors='none', animated=True)
+                        for c in colors]
+        for layer in self._layers:
+            self.ax.add_collection(layer)
+        self._background = None
+
+    def stack(self, x, y):
+        """ Show the rows of @y stacked up over @x, one per area """
+        width = max(int(self.ax.bbox.width), 1)
+        tops = np.cumsum(y, axis=0) if len(y) else np.zeros((0, len(x)))
+        xs, tops = downsample(np.asarray(x, float), tops, width)
+        bottom = np.zeros(len(xs))
+        for layer, top in zip(self._layers, tops):
+            layer.set_verts([np.column_stack((np.concatenate((xs, xs[::-1])),
+                                              np.concatenate((top, bottom[::-1]))))])
+            bottom = top
+
+        # Rescale with some room to spare, so it is seldom needed
+        highest = max(tops[-1].max() if len(tops) else 0, 1)
+        _, ymax = self.ax.get_ylim()
+        xlim = (xs[0], xs[-1]) if len(xs) > 1 else (0, 1)
+        if highest > ymax or highest < ymax / 2 or xlim != self._xlim:
+            self.ax.set_ylim(0, highest * 1.2)
+            self.ax.set_xlim(*xlim)
+            self._xlim = xlim
+            self._background = None
+
+        if self._background is None:
+            self.draw()
+        else:
+            self.restore_region(self._background)
+            self._draw_layers()
+            self.blit(self.ax.bbox)
+
 
 class MplWidget(QtGui.QWidget):
 